@@ -1,23 +1,81 @@
+import os
+
 import torch as tt
 from transformers import AutoProcessor, Qwen2_5_VLForConditionalGeneration
 from qwen_vl_utils import process_vision_info
 from skimage.transform import resize
+from skimage.util import img_as_float32
 import numpy as np
 from PIL import Image as PILImage
 
 
-def get_model_and_processor(model_id, max_pixels, device='mps'):
-    
+# Pick the torch device to run on (same rules as vlm_finetuning/backend.py).
+def select_device(device=None):
+    """The requested device, or the best available one: cuda, then mps, then cpu."""
+    if device is not None:
+        return tt.device(device)
+    if tt.cuda.is_available():
+        return tt.device('cuda')
+    if tt.backends.mps.is_available():
+        return tt.device('mps')
+    return tt.device('cpu')
+
+
+# Set the torch CPU thread pools of this process (same rules as vlm_finetuning/backend.py).
+def configure_cpu_threads(num_threads=None, interop_threads=1, num_workers=1):
+    """
+    Use num_threads intra-op threads, by default the physical cores this process
+    may run on split evenly between num_workers processes, and interop_threads
+    inter-op threads. Returns the number of intra-op threads.
+    """
+    if num_threads is None:
+        try:
+            import psutil
+            cores = psutil.cpu_count(logical=False)
+        except ImportError:
+            cores = None
+        cores = cores or os.cpu_count()
+        if hasattr(os, 'sched_getaffinity'):
+            cores = min(cores, len(os.sched_getaffinity(0)))
+        num_threads = max(1, cores // num_workers)
+    tt.set_num_threads(num_threads)
+    try:
+        tt.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        # can only be set once, before any inter-op parallel work has started
+        pass
+    return num_threads
+
+
+def get_model_and_processor(model_id, max_pixels, device=None, quantize=False, num_threads=None, min_pixels=None,
+                            interop_threads=1, num_workers=1):
+    """
+    Load the model and processor on the given device, or the best available one.
+
+    On CPU the model is kept in float32 and quantize=True applies dynamic int8
+    quantization to the linear layers. configure_cpu_threads sets num_threads
+    intra-op threads (default: the physical cores split between num_workers
+    processes) and interop_threads inter-op threads. min_pixels defaults to
+    max_pixels, so every image is resized to the same number of vision tokens.
+    """
+    device = select_device(device)
+    dtype = tt.float32 if device.type == 'cpu' else tt.bfloat16
+
     model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
         model_id,
-        torch_dtype=tt.bfloat16,
+        torch_dtype=dtype,
         #device_map="auto",
         ).to(device)
 
+    if device.type == 'cpu':
+        configure_cpu_threads(num_threads, interop_threads, num_workers)
+        if quantize:
+            model = tt.ao.quantization.quantize_dynamic(model, {tt.nn.Linear}, dtype=tt.qint8, inplace=True)
+
 
     # Get the processor
     processor = AutoProcessor.from_pretrained(model_id,
-                                              min_pixels=max_pixels,
+                                              min_pixels=max_pixels if min_pixels is None else min_pixels,
                                               max_pixels=max_pixels)
 
     return model, processor
@@ -53,9 +111,55 @@ def format_data(image, system_message):
         ]
     }
 
-def generate_description(image, model, processor, system_message, max_new_tokens=32, scale_factor=1):
-    # Scale the image
-    image = resize(image, (image.shape[0] * scale_factor, image.shape[1] * scale_factor), anti_aliasing=True)
+# Crop a cell to the ink inside its ruling lines.
+def crop_to_ink(image, ink_threshold=0.5, padding=4, min_size=28, **border_kwargs):
+    """
+    Crop a cell image (values in [0, 1]) to the bounding box of its ink.
+
+    Only ink inside the ruling lines found by utils.image_processing.strip_borders
+    counts (border_kwargs are passed on), so glyph strokes near the edge are kept
+    and lines deeper inside a misaligned crop are not. The box is grown by padding
+    pixels and to at least min_size pixels per side where the cell is large
+    enough, the processor needs one 28 pixel patch. Cells without ink are cropped
+    to the box inside their ruling lines.
+    """
+    from utils.image_processing import strip_borders
+
+    _, boxes = strip_borders(image[None], dark_threshold=ink_threshold, crop=False, **border_kwargs)
+    box = [int(edge) for edge in boxes[0]]
+    top, bottom, left, right = box
+    ink = image[top:bottom, left:right] < ink_threshold
+    ink_rows = np.flatnonzero(ink.any(axis=1))
+    ink_cols = np.flatnonzero(ink.any(axis=0))
+    if len(ink_rows) > 0:
+        box = [top + ink_rows[0], top + ink_rows[-1] + 1, left + ink_cols[0], left + ink_cols[-1] + 1]
+    for start, end, size in [(0, 1, image.shape[0]), (2, 3, image.shape[1])]:
+        # grow around the center, then shift the box back into the cell
+        grow = max(min_size - (box[end] - box[start]), 2 * padding)
+        box[start] -= grow // 2
+        box[end] += grow - grow // 2
+        box[end] -= min(box[start], 0)
+        box[start] -= max(box[end] - size, 0)
+        box[start], box[end] = max(box[start], 0), min(box[end], size)
+    return image[box[0]:box[1], box[2]:box[3]]
+
+def prepare_description_inputs(image, processor, system_message, scale_factor=1, crop=False):
+    """
+    Scale the image and build the model inputs on the CPU.
+
+    Split out of generate_description so it can run in worker threads while
+    the model is busy (see vlm_finetuning/pipeline.py).
+
+    With crop=True the cell is cropped to its ink and the processor resizes it
+    to its pixel budget, instead of the vision tokens depending on the cell size.
+    """
+    # values in [0, 1] whatever the input dtype (uint8 crops from a CellStore are 0...255),
+    # float32 since float64 doubles the cost of the resize
+    image = img_as_float32(image)
+    if crop:
+        image = crop_to_ink(image)
+    if scale_factor != 1:
+        image = resize(image, (image.shape[0] * scale_factor, image.shape[1] * scale_factor), anti_aliasing=True)
 
     image = image * 255
     image = image.astype(np.uint8)
@@ -73,15 +177,60 @@ def generate_description(image, model, processor, system_message, max_new_tokens
         images=image_inputs,
         padding=True,
         return_tensors="pt",
-        do_resize=False,
+        do_resize=crop,
     )
+    return inputs, text
+
+def generate_description(image, model, processor, system_message, max_new_tokens=32, scale_factor=1, cache=None,
+                         prefix_cache=None, crop=False):
+    """
+    Read a cell image with the model.
+
+    cache is an optional persistent prediction cache with make_key/get/put
+    methods, e.g. PredictionCache from vlm_finetuning/prediction_cache.py.
+
+    prefix_cache is an optional PrefixCache from vlm_finetuning/prefix_cache.py.
+    The KV cache of the system message is then computed once and reused for
+    every image, and decoding is greedy.
+
+    crop=True crops the cell to its ink and uses the processor's pixel budget
+    (see vlm_finetuning/vision_budget.py to calibrate it).
+    """
+    if cache is not None:
+        params = {
+            "shape": image.shape,
+            "dtype": str(image.dtype),
+            "max_new_tokens": max_new_tokens,
+            "scale_factor": scale_factor,
+            "top_p": 1.0,
+            "temperature": 0.1,
+            "max_pixels": processor.image_processor.max_pixels,
+            "prefix_cache": prefix_cache is not None,
+        }
+        if crop:
+            # the processor only resizes cropped cells
+            params.update(crop=True, min_pixels=processor.image_processor.min_pixels)
+        model_id = model.config._name_or_path
+        key = cache.make_key(np.ascontiguousarray(image).tobytes(), model_id, system_message, params)
+        cached = cache.get(key)
+        if cached is not None:
+            sample = format_data(image, system_message)
+            text = processor.apply_chat_template(
+                sample["messages"], tokenize=False, add_generation_prompt=True
+            )
+            return cached, text
+
+    inputs, text = prepare_description_inputs(image, processor, system_message, scale_factor, crop)
     inputs = inputs.to(model.device)
     
     # Inference: Generation of the output
     with tt.no_grad():
-        generated_ids = model.generate(
-            **inputs, max_new_tokens=max_new_tokens, top_p=1.0, do_sample=True, temperature=0.1
-        )
+        if prefix_cache is not None:
+            generated_ids = prefix_cache.generate(inputs, max_new_tokens=max_new_tokens)
+        else:
+            generated_ids = model.generate(
+                **inputs, max_new_tokens=max_new_tokens, top_p=1.0, do_sample=True, temperature=0.1
+            )
     generated_ids_trimmed = [
         out_ids[len(in_ids):]
         for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
@@ -91,4 +240,6 @@ def generate_description(image, model, processor, system_message, max_new_tokens
         skip_special_tokens=True,
         clean_up_tokenization_spaces=False,
     )
+    if cache is not None:
+        cache.put(key, output_text[0])
     return output_text[0], text 
\ No newline at end of file
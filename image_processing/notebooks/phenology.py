@@ -8,13 +8,21 @@ interaction, and species definitions.
 The module is organized into several submodules:
 - utils.coordinates: Coordinate-related utilities and constants
 - utils.image_processing: Image processing and visualization functions
+- utils.page_store: Decoded, deskewed pages in a memory-mapped page store
+- utils.cell_extraction: One-pass extraction of all fields into a memory-mapped cell store
+- utils.registration: FFT phase correlation registration of pages against a template
+- utils.grid_detection: Per-page ruling line positions from projection profiles
 - models.model_utils: Model interaction and data formatting functions
 - data.species_definitions: Species and phase definitions
 """
 
 from utils.coordinates import table_rows, table_cols, dms_to_decimal, parse_coordinates
-from utils.image_processing import show_selection, image_rotation_analysis, img_to_bytes, bytes_to_img, visualize_observation_phases, plot_projections, find_corner
-from models.model_utils import format_data, generate_description, get_model_and_processor
+from utils.image_processing import show_selection, image_rotation_analysis, image_rotation_analysis_batch, img_to_bytes, bytes_to_img, visualize_observation_phases, plot_projections, find_corner, strip_borders
+from utils.page_store import PageStore, ingest_pages, load_page_ref
+from utils.cell_extraction import CellStore, extract_cells, crop_page, field_boxes, field_image_bytes
+from utils.registration import phase_correlation, scale_rotation, register_pages, page_grid
+from utils.grid_detection import projection_profiles, detect_grid, detect_grids, anchored_box
+from models.model_utils import format_data, generate_description, prepare_description_inputs, crop_to_ink, get_model_and_processor, select_device, configure_cpu_threads
 from data.species_definitions import phases, species_list, generate_species_phase_dicts
 
 # Re-export all the necessary components
@@ -25,14 +33,36 @@ __all__ = [
     'parse_coordinates',
     'show_selection',
     'image_rotation_analysis',
+    'image_rotation_analysis_batch',
     'img_to_bytes',
     'bytes_to_img',
     'visualize_observation_phases',
     'plot_projections',
     'find_corner',
+    'strip_borders',
+    'PageStore',
+    'ingest_pages',
+    'load_page_ref',
+    'CellStore',
+    'extract_cells',
+    'crop_page',
+    'field_boxes',
+    'field_image_bytes',
+    'phase_correlation',
+    'scale_rotation',
+    'register_pages',
+    'page_grid',
+    'projection_profiles',
+    'detect_grid',
+    'detect_grids',
+    'anchored_box',
     'format_data',
     'generate_description',
+    'prepare_description_inputs',
+    'crop_to_ink',
     'get_model_and_processor',
+    'select_device',
+    'configure_cpu_threads',
     'phases',
     'species_list',
     'generate_species_phase_dicts'
@@ -0,0 +1,211 @@
+"""
+One-pass extraction of every field from the table pages.
+
+show_selection crops one field from every table per call. Here all fields of a
+page are cropped in one pass: fields with the same crop shape are gathered with
+a single fancy-indexing operation and normalized together. The crops go into a
+CellStore, one contiguous uint8 memory-mapped file indexed by (table, field).
+Pages are split between worker processes that write straight into the store,
+so re-extracting everything after a change to table_rows/table_cols is fast.
+
+Typical use:
+
+    fields = generate_species_phase_dicts(species_list)
+    store = extract_cells(page_paths, 'data/cells.u8', fields, table_rows, table_cols)
+    store[12, 'coltsfoot_flowering']     # one crop, uint8 0...255
+    store.field('coltsfoot_flowering')   # all tables, shape (num_tables, height, width)
+
+With per-page grids from detect_grids, pass grids=(rows, cols) to crop every
+page around its own ruling lines.
+"""
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image as PILImage
+
+from utils.grid_detection import anchored_box
+
+
+# Pixel box of every field, with the same offset as show_selection.
+def field_boxes(fields, table_rows, table_cols, offset=5):
+    """Return {field: (row_start, row_stop, col_start, col_stop)} for the fields of generate_species_phase_dicts."""
+    return {
+        name: (table_rows[info['row_start_idx']],
+               table_rows[info['row_end_idx']] + offset,
+               table_cols[info['col_start_idx']],
+               table_cols[info['col_end_idx']] + offset)
+        for name, info in fields.items()
+    }
+
+
+class CellStore:
+    """uint8 crops of every (table, field) in one contiguous memory-mapped file."""
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        with open(path + '.json') as f:
+            index = json.load(f)
+        self.num_tables = index['num_tables']
+        self.shapes = {name: tuple(shape) for name, shape in index['shapes'].items()}
+        self.offsets = index['offsets']
+        self.memmap = np.memmap(path, dtype=np.uint8, mode=mode, shape=(index['size'],))
+
+    @classmethod
+    def create(cls, path, num_tables, shapes):
+        """Allocate a store for num_tables tables and the given {field: (height, width)} crop shapes."""
+        offsets = {}
+        size = 0
+        for name, (height, width) in shapes.items():
+            offsets[name] = size
+            size += num_tables * height * width
+        index = {'num_tables': num_tables,
+                 'shapes': {name: list(shape) for name, shape in shapes.items()},
+                 'offsets': offsets,
+                 'size': size}
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.memmap(path, dtype=np.uint8, mode='w+', shape=(max(size, 1),)).flush()
+        with open(path + '.json', 'w') as f:
+            json.dump(index, f)
+        return cls(path, mode='r+')
+
+    @property
+    def fields(self):
+        return list(self.shapes)
+
+    def field(self, name):
+        """All crops of a field, shape (num_tables, height, width), without copying."""
+        height, width = self.shapes[name]
+        start = self.offsets[name]
+        size = self.num_tables * height * width
+        return self.memmap[start:start + size].reshape(self.num_tables, height, width)
+
+    def __getitem__(self, key):
+        table, name = key
+        return self.field(name)[table]
+
+    def flush(self):
+        self.memmap.flush()
+
+
+def _load_page(page):
+    # pages are arrays, image files or PageStore references that the worker reads itself
+    if isinstance(page, (str, os.PathLike)):
+        return np.asarray(PILImage.open(page).convert('L'))
+    if isinstance(page, tuple):
+        from utils.page_store import load_page_ref
+        return load_page_ref(page)
+    return np.asarray(page)
+
+
+def _shape_groups(boxes, rotated_fields):
+    """Group fields by crop shape so each group is cropped with one gather."""
+    groups = {}
+    for name, (r0, r1, c0, c1) in boxes.items():
+        groups.setdefault((r1 - r0, c1 - c0, name in rotated_fields), []).append(name)
+    return groups
+
+
+# Crop and normalize all fields of one page.
+def crop_page(page, boxes, rotated_fields=()):
+    """
+    Crop every field of a page and normalize each crop to 0...255 like show_selection.
+
+    Returns {field: uint8 crop}. Fields in rotated_fields are rotated like
+    show_selection(rotate=True). Boxes that run over the page edge are padded
+    with the brightest value of the page.
+    """
+    page = _load_page(page)
+    max_row = max(box[1] for box in boxes.values())
+    max_col = max(box[3] for box in boxes.values())
+    if max_row > page.shape[0] or max_col > page.shape[1]:
+        page = np.pad(page, ((0, max(max_row - page.shape[0], 0)), (0, max(max_col - page.shape[1], 0))),
+                      constant_values=page.max())
+
+    crops = {}
+    for (height, width, rotate), names in _shape_groups(boxes, rotated_fields).items():
+        row_starts = np.array([boxes[name][0] for name in names])
+        col_starts = np.array([boxes[name][2] for name in names])
+        rows = row_starts[:, None, None] + np.arange(height)[None, :, None]
+        cols = col_starts[:, None, None] + np.arange(width)[None, None, :]
+        group = page[rows, cols].astype(np.float32)  # (fields, height, width)
+
+        # per crop min/max normalization, flat crops become white
+        low = group.min(axis=(1, 2), keepdims=True)
+        span = group.max(axis=(1, 2), keepdims=True) - low
+        group = np.where(span > 0, (group - low) / np.where(span > 0, span, 1), 1.0)
+        group = np.round(group * 255).astype(np.uint8)
+        if rotate:
+            group = np.rot90(group, k=3, axes=(1, 2))
+        for name, crop in zip(names, group):
+            crops[name] = crop
+    return crops
+
+
+def _extract_pages(store_path, table_indexes, pages, page_boxes, rotated_fields):
+    store = CellStore(store_path, mode='r+')
+    for table, page, boxes in zip(table_indexes, pages, page_boxes):
+        for name, crop in crop_page(page, boxes, rotated_fields).items():
+            store.field(name)[table] = crop
+    store.flush()
+    return len(table_indexes)
+
+
+# Crop all fields of all pages into a CellStore.
+def extract_cells(pages, store_path, fields, table_rows, table_cols, offset=5, rotated_fields=(),
+                  num_workers=None, pages_per_task=8, grids=None):
+    """
+    Crop every field of every page into a CellStore at store_path.
+
+    pages is a sequence of page arrays, image file paths or PageStore.refs()
+    (paths and references are cheaper to send to the workers). fields comes from generate_species_phase_dicts.
+    num_workers processes (default: all cores) each take pages_per_task pages
+    at a time, num_workers=1 runs in this process.
+
+    grids=(rows, cols) from detect_grids crops every page around its own
+    lines. The crop sizes still come from table_rows/table_cols.
+    """
+    boxes = field_boxes(fields, table_rows, table_cols, offset)
+    rotated_fields = set(rotated_fields)
+    shapes = {}
+    for name, (r0, r1, c0, c1) in boxes.items():
+        shape = (r1 - r0, c1 - c0)
+        shapes[name] = shape[::-1] if name in rotated_fields else shape
+    store = CellStore.create(store_path, len(pages), shapes)
+
+    if grids is None:
+        page_boxes = [boxes] * len(pages)
+    else:
+        page_boxes = [{name: anchored_box(rows, cols, info, r1 - r0, c1 - c0, offset)
+                       for (name, info), (r0, r1, c0, c1) in zip(fields.items(), boxes.values())}
+                      for rows, cols in zip(*grids)]
+
+    tasks = [(list(range(start, min(start + pages_per_task, len(pages)))),
+              list(pages[start:start + pages_per_task]),
+              page_boxes[start:start + pages_per_task])
+             for start in range(0, len(pages), pages_per_task)]
+    num_workers = num_workers or os.cpu_count()
+    if num_workers == 1:
+        for table_indexes, task_pages, task_boxes in tasks:
+            _extract_pages(store_path, table_indexes, task_pages, task_boxes, rotated_fields)
+    else:
+        with ProcessPoolExecutor(num_workers) as executor:
+            futures = [executor.submit(_extract_pages, store_path, table_indexes, task_pages, task_boxes,
+                                       rotated_fields)
+                       for table_indexes, task_pages, task_boxes in tasks]
+            for future in futures:
+                future.result()
+
+    # reopen so this process sees what the workers wrote
+    return CellStore(store_path)
+
+
+# Encode the crops of one field like img_to_bytes, for the *_image dataframe columns.
+def field_image_bytes(store, name):
+    """Return the crops of a field as PNG bytes, one per table."""
+    from utils.image_processing import img_to_bytes
+
+    return [img_to_bytes(crop / 255) for crop in store.field(name)]
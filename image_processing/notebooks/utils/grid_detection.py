@@ -0,0 +1,151 @@
+"""
+Find the ruling lines of every table page from its projection profiles.
+
+table_rows and table_cols hold one set of line positions for all pages, so a
+page that is shifted or stretched a few pixels gets clipped cells. detect_grid
+finds the actual lines of one page from the horizontal and vertical
+projections that plot_projections shows:
+
+1. the profile is smoothed and searched for the shift and scale of the
+   expected grid that covers the most ink (all candidates are scored at once),
+2. every expected line is snapped to the strongest peak within window pixels
+   of its predicted position, lines without a clear peak keep the prediction.
+
+The result always has the 24 x 21 topology of table_rows/table_cols, so it can
+replace them per page. detect_grids runs this for all pages and caches the
+grids in an npz file, keyed by page content and parameters, so only new or
+changed pages are processed again.
+
+Typical use:
+
+    rows, cols = detect_grids(tables, table_rows, table_cols, cache_path='data/grids.npz')
+    show_selection(tables, info_dict, table_rows=rows, table_cols=cols)
+    extract_cells(tables, 'data/cells.u8', fields, table_rows, table_cols, grids=(rows, cols))
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+from scipy import ndimage
+
+
+# Ink per image row and column, as in plot_projections.
+def projection_profiles(image):
+    """Return (h_proj, v_proj), the sums of the inverted image along rows and columns."""
+    image = np.asarray(image, dtype=np.float32)
+    inverted = image.max() - image
+    return inverted.sum(axis=1), inverted.sum(axis=0)
+
+
+def _snap_lines(profile, expected, max_shift, max_scale, scale_step, window, min_strength):
+    """Positions of the expected lines on one profile, see the module docstring."""
+    expected = np.asarray(expected, dtype=np.float64)
+    smooth = ndimage.gaussian_filter1d(profile.astype(np.float64), 1.5)
+    # lines stand out from the local background of handwriting and paper
+    smooth = smooth - ndimage.median_filter(smooth, size=4 * window + 1, mode='nearest')
+    smooth = np.maximum(smooth, 0)
+
+    # score every (scale, shift) candidate of the whole grid in one gather
+    shifts = np.arange(-max_shift, max_shift + 1)
+    scales = np.arange(1 - max_scale, 1 + max_scale + scale_step / 2, scale_step)
+    predicted = expected[None, None, :] * scales[:, None, None] + shifts[None, :, None]
+    indexes = np.clip(np.round(predicted).astype(int), 0, len(smooth) - 1)
+    inside = (predicted >= 0) & (predicted < len(smooth))
+    scores = (smooth[indexes] * inside).sum(axis=2)
+    best_scale, best_shift = np.unravel_index(scores.argmax(), scores.shape)
+    predicted = np.round(predicted[best_scale, best_shift]).astype(int)
+
+    # snap each line to the strongest peak in its window
+    offsets = np.arange(-window, window + 1)
+    candidates = np.clip(predicted[:, None] + offsets[None, :], 0, len(smooth) - 1)
+    strengths = smooth[candidates]
+    snapped = candidates[np.arange(len(expected)), strengths.argmax(axis=1)]
+
+    # faint or missing lines keep the position predicted from the rest of the grid
+    peak_strength = strengths.max(axis=1)
+    clear = peak_strength >= min_strength * np.median(peak_strength)
+    return np.where(clear, snapped, np.clip(predicted, 0, len(smooth) - 1))
+
+
+# Row and column lines of one page.
+def detect_grid(page, table_rows, table_cols, max_shift=40, max_scale=0.03, scale_step=0.002, window=8,
+                min_strength=0.3):
+    """
+    Find the ruling lines of one table page.
+
+    The expected grid (table_rows, table_cols) may be shifted by up to
+    max_shift pixels and scaled by up to max_scale along each axis. Returns
+    (rows, cols) integer arrays with the same length as table_rows and table_cols.
+    """
+    h_proj, v_proj = projection_profiles(page)
+    rows = _snap_lines(h_proj, table_rows, max_shift, max_scale, scale_step, window, min_strength)
+    cols = _snap_lines(v_proj, table_cols, max_shift, max_scale, scale_step, window, min_strength)
+    return rows, cols
+
+
+def _page_key(page):
+    # files and PageStore references are identified by path and modification, arrays by their content
+    if isinstance(page, (str, os.PathLike)):
+        stat = os.stat(page)
+        return f"{os.path.abspath(page)}:{stat.st_size}:{stat.st_mtime_ns}"
+    if isinstance(page, tuple):
+        path, index = page
+        return f"{_page_key(path)}:{index}"
+    page = np.ascontiguousarray(page)
+    return hashlib.sha1(page.tobytes() + str(page.shape).encode()).hexdigest()
+
+
+# Row and column lines of every page, cached on disk.
+def detect_grids(pages, table_rows, table_cols, cache_path=None, **kwargs):
+    """
+    Run detect_grid on every page.
+
+    pages is a sequence of page arrays, image file paths or PageStore.refs().
+    With cache_path, grids are stored in an npz file and reused for pages that
+    did not change, as long as table_rows, table_cols and kwargs are the same.
+    Returns
+    (rows, cols) with shapes (num_pages, len(table_rows)) and
+    (num_pages, len(table_cols)).
+    """
+    from utils.cell_extraction import _load_page
+
+    params = json.dumps({'table_rows': list(map(int, table_rows)), 'table_cols': list(map(int, table_cols)),
+                         **kwargs}, sort_keys=True)
+    cached = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with np.load(cache_path) as data:
+            if str(data['params']) == params:
+                cached = {key: (rows, cols) for key, rows, cols in zip(data['keys'], data['rows'], data['cols'])}
+
+    keys = [_page_key(page) for page in pages]
+    rows = np.zeros((len(pages), len(table_rows)), dtype=np.int64)
+    cols = np.zeros((len(pages), len(table_cols)), dtype=np.int64)
+    for i, (key, page) in enumerate(zip(keys, pages)):
+        if key not in cached:
+            cached[key] = detect_grid(_load_page(page), table_rows, table_cols, **kwargs)
+        rows[i], cols[i] = cached[key]
+
+    if cache_path is not None:
+        if os.path.dirname(cache_path):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        np.savez(cache_path, params=params, keys=np.array(keys), rows=rows, cols=cols)
+    return rows, cols
+
+
+# Crop box of a field on a page with its own grid.
+def anchored_box(rows, cols, info, height, width, offset=5):
+    """
+    (row_start, row_stop, col_start, col_stop) of a field on one page.
+
+    info is an entry of generate_species_phase_dicts and rows, cols the grid
+    of the page. The box has the fixed size height x width (the field's size
+    on the fixed grid, including offset) so the crops of all pages stack. It
+    is centered on the field's lines on this page, so a page whose lines are
+    a little further apart loses the same few pixels on both sides.
+    """
+    row_start = (rows[info['row_start_idx']] + rows[info['row_end_idx']] - (height - offset)) // 2
+    col_start = (cols[info['col_start_idx']] + cols[info['col_end_idx']] - (width - offset)) // 2
+    row_start, col_start = max(int(row_start), 0), max(int(col_start), 0)
+    return row_start, row_start + height, col_start, col_start + width
@@ -6,6 +6,7 @@ from skimage.morphology import dilation, disk
 from skimage.transform import resize
 from PIL import Image as PILImage
 import io
+from utils.grid_detection import anchored_box
 
 
 # Display selected regions from tables with optional rotation and dilation.
@@ -20,18 +21,34 @@ def show_selection(tables,
                    show_images=True,
                    table_rows=None,
                    table_cols=None,
-                   use_dilation=False):
-    """Display selected regions from tables with optional rotation and dilation."""
+                   use_dilation=False,
+                   remove_borders=False):
+    """
+    Display selected regions from tables with optional rotation and dilation.
+
+    With remove_borders=True the ruling lines that the offset pulls into the
+    crops are removed with strip_borders.
+
+    table_rows and table_cols can also be per-table grids from detect_grids,
+    shape (num_tables, num_lines). Every table is then cropped around its own
+    lines, with the median size over all tables.
+    """
     # Get the coordinates from the info_dict
     start_r_idx = info_dict['row_start_idx']
     stop_r_idx = info_dict['row_end_idx']
     start_c_idx = info_dict['col_start_idx']
     stop_c_idx = info_dict['col_end_idx']
 
-    start_r = table_rows[start_r_idx]
-    stop_r = table_rows[stop_r_idx]
-    start_c = table_cols[start_c_idx]
-    stop_c = table_cols[stop_c_idx]
+    per_table = np.ndim(table_rows) == 2
+    if per_table:
+        table_rows, table_cols = np.asarray(table_rows), np.asarray(table_cols)
+        height = int(np.median(table_rows[:, stop_r_idx] - table_rows[:, start_r_idx])) + offset
+        width = int(np.median(table_cols[:, stop_c_idx] - table_cols[:, start_c_idx])) + offset
+    else:
+        start_r = table_rows[start_r_idx]
+        stop_r = table_rows[stop_r_idx]
+        start_c = table_cols[start_c_idx]
+        stop_c = table_cols[stop_c_idx]
 
     # Select random table
     if selection_size is not None:
@@ -39,11 +56,15 @@ def show_selection(tables,
     else:
         indexes = range(len(tables))
     images = []
-    for table in tables:
+    for table_idx, table in enumerate(tables):
+        if per_table:
+            r0, r1, c0, c1 = anchored_box(table_rows[table_idx], table_cols[table_idx], info_dict, height, width, offset)
+        else:
+            r0, r1, c0, c1 = start_r, stop_r + offset, start_c, stop_c + offset
         if not rotate:
-            tmp_img = table[start_r:(stop_r + offset), start_c:(stop_c + offset)]
+            tmp_img = table[r0:r1, c0:c1]
         else:
-            tmp_img = table[start_r:(stop_r + offset), start_c:(stop_c + offset)]
+            tmp_img = table[r0:r1, c0:c1]
             tmp_img = np.rot90(tmp_img, k=3)
 
         # Normalize the image
@@ -58,6 +79,9 @@ def show_selection(tables,
 
         images.append(tmp_img)
 
+    if remove_borders and len(images) > 0:
+        images = list(strip_borders(np.stack(images))[0])
+
     # Plot the images
     if show_images:
         fig, axs = plt.subplots(subplot_size[0], subplot_size[1], figsize=figsize)
@@ -69,12 +93,76 @@ def show_selection(tables,
     return images
 
 # Analyze optimal rotation angle for images using projected sums.
-def image_rotation_analysis(image, rotations=[-1, 1], rotation_step=0.1):
-    """Analyze optimal rotation angle for images using projected sums."""
+def image_rotation_analysis(image, rotations=[-1, 1], rotation_step=0.1, method='shear', downsample=4):
+    """
+    Analyze optimal rotation angle for images using projected sums.
+
+    The angle is the one that makes the column sums of the edge map peak after
+    rotation. method='rotate' rotates the full edge map for every step and
+    maximizes the largest column sum. method='shear' (default) shears the edge
+    pixel coordinates instead, which is the same as a rotation for angles this
+    small. It searches a downsampled edge map first, refines at full resolution
+    around the best angle, and fits a parabola through the peak for an angle
+    between the steps.
+    """
     # Begin by detection edges in the image using the Beucher transform
     edges = ndimage.morphological_gradient(image, size=(3,3))
     edges = edges > edges.std()
 
+    if method == 'rotate':
+        return _rotation_analysis_rotate(edges, rotations, rotation_step)
+    if method != 'shear':
+        raise ValueError(f"Unknown method {method}")
+
+    # Coarse search on the downsampled edge map, with twice the step
+    coarse_angles = np.arange(rotations[0], rotations[1], 2 * rotation_step)
+    height, width = edges.shape[0] // downsample, edges.shape[1] // downsample
+    small = edges[:height * downsample, :width * downsample]
+    small = small.reshape(height, downsample, width, downsample).any(axis=(1, 3))
+    coarse_scores = _sheared_column_peaks(small, coarse_angles)
+    best = coarse_angles[np.argmax(coarse_scores)]
+
+    # Refine at full resolution around the coarse angle, with half the step
+    fine_step = rotation_step / 2
+    fine_angles = best + fine_step * np.arange(-4, 5)
+    fine_angles = fine_angles[(fine_angles >= rotations[0] - fine_step) & (fine_angles < rotations[1])]
+    fine_scores = _sheared_column_peaks(edges, fine_angles)
+    i = int(np.argmax(fine_scores))
+
+    # Parabolic fit through the peak and its neighbours
+    angle = fine_angles[i]
+    if 0 < i < len(fine_scores) - 1:
+        left, center, right = fine_scores[i - 1:i + 2]
+        curvature = left - 2 * center + right
+        if curvature < 0:
+            angle += 0.5 * (left - right) / curvature * fine_step
+    return float(np.clip(angle, rotations[0], rotations[1]))
+
+# Sharpness of the column sums of an edge map after shearing it by each angle.
+def _sheared_column_peaks(edges, angles):
+    """
+    Shear x by y * tan(angle), which is what a small rotation does to the
+    columns, bin the edge pixels per column and score the column sums.
+
+    The largest column sum that the rotate method maximizes is flat over a
+    range of angles (a few pixel wide ruling line stays in its columns), the
+    sum of squared column sums peaks at the center of that range.
+    """
+    ys, xs = np.nonzero(edges)
+    if len(ys) == 0:
+        return np.zeros(len(angles))
+    shifts = np.tan(np.deg2rad(np.asarray(angles)))[:, None] * ys[None, :]
+    columns = np.round(xs[None, :] + shifts).astype(np.int64)
+    columns -= columns.min()
+    num_columns = columns.max() + 1
+    # one bincount for all angles, each angle gets its own range of bins
+    columns += np.arange(len(angles))[:, None] * num_columns
+    counts = np.bincount(columns.ravel(), minlength=len(angles) * num_columns)
+    counts = counts.reshape(len(angles), num_columns).astype(np.float64)
+    return (counts ** 2).sum(axis=1)
+
+# The original search, rotating the full edge map for every step.
+def _rotation_analysis_rotate(edges, rotations, rotation_step):
     # Now loop over rotations in the rotation variable and calculate the sum of the pixels along the rows
     sum_of_rows_max_list = []
     for r in np.arange(rotations[0], rotations[1], rotation_step):
@@ -87,23 +175,37 @@ def image_rotation_analysis(image, rotations=[-1, 1], rotation_step=0.1):
 
     return max_sum_of_rows_rotation
 
+# Rotation angles of many pages in parallel.
+def image_rotation_analysis_batch(images, num_workers=None, **kwargs):
+    """Run image_rotation_analysis on every image with a process pool, kwargs are passed on."""
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
+
+    with ProcessPoolExecutor(num_workers) as executor:
+        return list(executor.map(partial(image_rotation_analysis, **kwargs), images, chunksize=4))
+
 # Convert numpy image array to bytes.
-def img_to_bytes(image):
-    """Convert numpy image array to bytes."""
+def img_to_bytes(image, format='PNG'):
+    """
+    Convert numpy image array to bytes.
+
+    Cells are stored as lossless grayscale PNG by default, a fraction of the
+    size of the uncompressed TIFF used before (format='TIFF').
+    """
     image = 255 * image
     image = image.astype(np.uint8)
     image = PILImage.fromarray(image)
     img_byte_arr = io.BytesIO()
-    image.save(img_byte_arr, format='TIFF')
+    image.save(img_byte_arr, format=format)
     img_byte_str = img_byte_arr.getvalue()
     return img_byte_str
 
 # Convert bytes to PIL Image.
-def bytes_to_img(img_byte_str):
-    """Convert bytes to PIL Image."""
+def bytes_to_img(img_byte_str, mode="RGB"):
+    """Convert bytes to PIL Image, mode='L' keeps single channel cells grayscale."""
     img_byte_arr = io.BytesIO(img_byte_str)
     image = PILImage.open(img_byte_arr)
-    return image.convert("RGB") 
+    return image.convert(mode)
 
 # Plot vertical and horizontal projections of an image.
 def plot_projections(image, figsize_v=(12, 15), figsize_h=(15, 10)):
@@ -148,6 +250,70 @@ def plot_projections(image, figsize_v=(12, 15), figsize_h=(15, 10)):
 
     return fig1, fig2, h_proj, v_proj
 
+# Remove ruling lines and border residue from a stack of cell crops.
+def strip_borders(stack, dark_threshold=0.5, line_fraction=0.8, band_fraction=0.25, line_padding=1, crop=True,
+                  paper_fraction=0.05, passes=2):
+    """
+    Remove the ruling lines at the edges of a stack of cell crops in one pass.
+
+    stack has shape (n, height, width) with values in 0...1 (as returned by
+    show_selection). Like plot_projections, dark pixels are summed along every
+    row and column. Rows (columns) within band_fraction of the top/bottom
+    (left/right) edge that are dark over more than line_fraction of their
+    length are ruling lines, if only paper (at most paper_fraction dark) and
+    other lines lie between them and the edge. Scanning from the edge stops at
+    the first row with other ink, so glyph strokes near the edge are kept.
+    Everything from the edge up to the last line passed, plus line_padding
+    pixels of residue, is set to white. Rows are measured between the column
+    lines found so far and vice versa, passes times.
+
+    With crop=True the stack is also cropped by the border that was removed
+    from every cell, so the cells get smaller without losing any content.
+    Returns the stripped stack and the (top, bottom, left, right) content box
+    of every cell.
+    """
+    stack = np.asarray(stack, dtype=np.float32)
+    num_cells, height, width = stack.shape
+    dark = stack < dark_threshold
+    cells = np.arange(num_cells)
+
+    # dark pixels per row (column) between any two columns (rows), from cumulative sums
+    row_sums = np.pad(dark.cumsum(axis=2), ((0, 0), (0, 0), (1, 0)))
+    col_sums = np.pad(dark.cumsum(axis=1), ((0, 0), (1, 0), (0, 0)))
+
+    def leading_edge(counts, lengths, size):
+        # first content index after the lines connected to the leading edge
+        band = max(1, int(size * band_fraction))
+        fractions = counts[:, :band] / np.maximum(lengths, 1)[:, None]
+        is_line = fractions > line_fraction
+        lines = is_line & np.logical_and.accumulate(is_line | (fractions <= paper_fraction), axis=1)
+        last_line = band - 1 - np.argmax(lines[:, ::-1], axis=1)
+        return np.minimum(np.where(lines.any(axis=1), last_line + 1 + line_padding, 0), size)
+
+    top = np.zeros(num_cells, dtype=int)
+    bottom = np.full(num_cells, height)
+    left = np.zeros(num_cells, dtype=int)
+    right = np.full(num_cells, width)
+    for _ in range(passes):
+        counts = row_sums[cells, :, right] - row_sums[cells, :, left]
+        top = leading_edge(counts, right - left, height)
+        bottom = np.maximum(height - leading_edge(counts[:, ::-1], right - left, height), top)
+        counts = col_sums[cells, bottom, :] - col_sums[cells, top, :]
+        left = leading_edge(counts, bottom - top, width)
+        right = np.maximum(width - leading_edge(counts[:, ::-1], bottom - top, width), left)
+
+    rows = np.arange(height)
+    cols = np.arange(width)
+    inside = ((rows >= top[:, None]) & (rows < bottom[:, None]))[:, :, None] \
+        & ((cols >= left[:, None]) & (cols < right[:, None]))[:, None, :]
+    stripped = np.where(inside, stack, 1.0)
+
+    boxes = np.stack([top, bottom, left, right], axis=1)
+    if crop and num_cells > 0:
+        # crop only what was removed from every cell
+        stripped = stripped[:, top.min():bottom.max(), left.min():right.max()]
+    return stripped, boxes
+
 # Find the corner of a table in an image.
 def find_corner(corner_candidate, corner_name):
     nonzero_y, nonzero_x = np.nonzero(corner_candidate)
@@ -0,0 +1,187 @@
+"""
+Decoded, deskewed pages of the scanned tables in one memory-mapped file.
+
+Decoding all scans in data/raw into a list of float arrays takes a while and
+holds every page in RAM. ingest_pages does it once: every scan is converted to
+grayscale, deskewed with image_rotation_analysis and written as uint8 into a
+PageStore, one contiguous memory-mapped file with a JSON index (table id,
+shape, offset, source file and rotation angle per page). Opening the store
+afterwards only reads the index, and pages are read from disk when they are
+used, so memory stays flat whatever the scan resolution.
+
+store[i] is a zero-copy (height, width) uint8 view of page i and store[a:b] a
+list of views, which show_selection, detect_grids, register_pages and
+image_rotation_analysis accept like the list of decoded tables. Worker
+processes (extract_cells, detect_grids) get store.refs() instead, small
+(path, index) references they open themselves, so no page is pickled.
+
+Typical use:
+
+    store = ingest_pages(sorted(glob('data/raw/*.jpg')), 'data/pages.u8')
+    tables = store[:]
+    show_selection(tables, info_dict, table_rows=table_rows, table_cols=table_cols)
+    extract_cells(store.refs(), 'data/cells.u8', fields, table_rows, table_cols)
+"""
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image as PILImage
+from scipy import ndimage
+
+
+class PageStore:
+    """uint8 grayscale pages of any size in one contiguous memory-mapped file."""
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        with open(path + '.json') as f:
+            index = json.load(f)
+        self.pages = index['pages']
+        # False until ingest_pages has written every page
+        self.complete = index.get('complete', False)
+        self.shapes = [tuple(page['shape']) for page in self.pages]
+        self.memmap = np.memmap(path, dtype=np.uint8, mode=mode, shape=(max(index['size'], 1),))
+
+    @classmethod
+    def create(cls, path, table_ids, shapes, sources=None):
+        """Allocate a store for pages with the given ids and (height, width) shapes."""
+        sources = sources if sources is not None else [None] * len(table_ids)
+        pages = []
+        size = 0
+        for table_id, (height, width), source in zip(table_ids, shapes, sources):
+            pages.append({'table_id': table_id, 'shape': [height, width], 'offset': size, 'source': source,
+                          'angle': None})
+            size += height * width
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.memmap(path, dtype=np.uint8, mode='w+', shape=(max(size, 1),)).flush()
+        cls._write_index(path, pages, size, complete=False)
+        return cls(path, mode='r+')
+
+    @staticmethod
+    def _write_index(path, pages, size, complete):
+        with open(path + '.json', 'w') as f:
+            json.dump({'pages': pages, 'size': size, 'complete': complete}, f)
+
+    @property
+    def table_ids(self):
+        return [page['table_id'] for page in self.pages]
+
+    @property
+    def angles(self):
+        """Rotation angle applied to every page by ingest_pages."""
+        return [page['angle'] for page in self.pages]
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self)))]
+        page = self.pages[key]
+        height, width = page['shape']
+        return self.memmap[page['offset']:page['offset'] + height * width].reshape(height, width)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def page(self, table_id):
+        """The page with the given table id."""
+        return self[self.table_ids.index(table_id)]
+
+    def stack(self):
+        """All pages as one (num_pages, height, width) view, if they have the same shape."""
+        if len(set(self.shapes)) != 1:
+            raise ValueError("Pages have different shapes, use store[i] instead")
+        height, width = self.shapes[0]
+        return self.memmap[:len(self) * height * width].reshape(len(self), height, width)
+
+    def refs(self):
+        """(path, index) references to every page, for worker processes."""
+        return [(self.path, i) for i in range(len(self))]
+
+    def flush(self):
+        self.memmap.flush()
+
+
+@lru_cache(maxsize=8)
+def _open_store(path, index_mtime):
+    # the index modification time is part of the key, so a new ingest is picked up
+    return PageStore(path)
+
+
+# Page array of a (path, index) reference from PageStore.refs.
+def load_page_ref(ref):
+    """Return the zero-copy view of a page reference, opening each store once per process."""
+    path, index = ref
+    return _open_store(path, os.stat(path + '.json').st_mtime_ns)[index]
+
+
+def _source_id(path):
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def _ingest_page(store_path, index, path, deskew, rotation_kwargs):
+    from utils.image_processing import image_rotation_analysis
+
+    image = np.asarray(PILImage.open(path).convert('L'), dtype=np.float32) / 255
+    angle = 0.0
+    if deskew:
+        angle = image_rotation_analysis(image, **rotation_kwargs)
+        image = ndimage.rotate(image, angle, reshape=False, order=1, mode='nearest')
+    store = PageStore(store_path, mode='r+')
+    store[index][:] = np.round(np.clip(image, 0, 1) * 255).astype(np.uint8)
+    store.flush()
+    return angle
+
+
+# Decode, deskew and store all scans once.
+def ingest_pages(paths, store_path, table_ids=None, deskew=True, num_workers=None, overwrite=False,
+                 **rotation_kwargs):
+    """
+    Write the scans at paths into a PageStore at store_path and return it.
+
+    table_ids defaults to the file names without extension. Pages are rotated
+    by the angle from image_rotation_analysis (rotation_kwargs are passed on)
+    unless deskew=False. If a finished store already holds exactly these
+    files, unchanged, it is opened instead, so only the first call decodes
+    anything. An interrupted ingest is started again.
+    num_workers processes (default: all cores) each decode one page at a time.
+    """
+    paths = [os.fspath(path) for path in paths]
+    sources = [_source_id(path) for path in paths]
+    if table_ids is None:
+        table_ids = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    if not overwrite and os.path.exists(store_path + '.json'):
+        store = PageStore(store_path)
+        if (store.complete and None not in store.angles and store.table_ids == list(table_ids)
+                and [page['source'] for page in store.pages] == sources):
+            return store
+
+    # the image header has the size, nothing is decoded here
+    shapes = []
+    for path in paths:
+        with PILImage.open(path) as image:
+            shapes.append(image.size[::-1])
+    store = PageStore.create(store_path, list(table_ids), shapes, sources)
+
+    num_workers = num_workers or os.cpu_count()
+    if num_workers == 1:
+        angles = [_ingest_page(store_path, i, path, deskew, rotation_kwargs) for i, path in enumerate(paths)]
+    else:
+        with ProcessPoolExecutor(num_workers) as executor:
+            futures = [executor.submit(_ingest_page, store_path, i, path, deskew, rotation_kwargs)
+                       for i, path in enumerate(paths)]
+            angles = [future.result() for future in futures]
+
+    for page, angle in zip(store.pages, angles):
+        page['angle'] = float(angle)
+    # only now is the store marked complete, so an interrupted ingest is never reused
+    PageStore._write_index(store_path, store.pages, sum(height * width for height, width in shapes), complete=True)
+    # reopen read-only so this process sees what the workers wrote
+    return PageStore(store_path)
@@ -0,0 +1,206 @@
+"""
+Register scanned pages against a reference table template with FFT phase correlation.
+
+table_rows and table_cols were measured on one page. Every other scan is a bit
+shifted (and sometimes scaled or rotated) relative to it, which find_corner
+only partly corrects. register_pages estimates, for a whole batch of pages at
+once, the transform that maps the template onto each page:
+
+- translation from the peak of the phase correlation, refined to sub-pixel
+  accuracy with an upsampled DFT around the peak,
+- optionally scale and rotation from the phase correlation of the log-polar
+  resampled magnitude spectra (Fourier-Mellin), which do not depend on the
+  translation.
+
+page_grid then maps the fixed grid coordinates onto each page.
+"""
+
+import numpy as np
+from scipy import fft, ndimage
+
+
+def _window(shape):
+    """2D Hann window, so the page borders do not dominate the spectrum."""
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1])).astype(np.float32)
+
+
+def _as_stack(images, shape):
+    stack = np.asarray(images, dtype=np.float32)
+    if stack.ndim == 2:
+        stack = stack[None]
+    if stack.shape[1:] != tuple(shape):
+        raise ValueError(f"Pages have shape {stack.shape[1:]}, the template has shape {tuple(shape)}")
+    return stack
+
+
+def _integer_peaks(correlation):
+    """Signed integer (dy, dx) of the correlation peak of every image."""
+    num_images, height, width = correlation.shape
+    flat_peak = correlation.reshape(num_images, -1).argmax(axis=1)
+    peaks = np.stack(np.unravel_index(flat_peak, (height, width)), axis=1)
+    # the correlation is circular, peaks past the middle are negative shifts
+    size = np.array([height, width])
+    return np.where(peaks > size // 2, peaks - size, peaks).astype(np.float64)
+
+
+def _refine_peaks(cross_power, peaks, shape, upsample_factor):
+    """
+    Refine integer peaks to 1 / upsample_factor pixels by evaluating the
+    inverse DFT of the cross power spectrum on a fine grid around each peak
+    only (matrix-multiply DFT, Guizar-Sicairos et al. 2008).
+    """
+    height, width = shape
+    size = int(np.ceil(1.5 * upsample_factor))
+    offsets = (np.arange(size) - size // 2) / upsample_factor
+    freq_y = fft.fftfreq(height) * height
+    freq_x = fft.rfftfreq(width) * width
+    # rfft only holds half the spectrum, the other half is its complex conjugate
+    weights = np.full(freq_x.shape, 2.0)
+    weights[0] = 1
+    if width % 2 == 0:
+        weights[-1] = 1
+
+    ys = peaks[:, 0, None] + offsets[None, :]
+    xs = peaks[:, 1, None] + offsets[None, :]
+    kernel_y = np.exp(2j * np.pi * ys[:, :, None] * freq_y[None, None, :] / height)
+    kernel_x = np.exp(2j * np.pi * freq_x[None, :, None] * xs[:, None, :] / width)
+    upsampled = (kernel_y @ (cross_power * weights) @ kernel_x).real  # (n, size, size)
+
+    flat_peak = upsampled.reshape(len(peaks), -1).argmax(axis=1)
+    row, col = np.unravel_index(flat_peak, (size, size))
+    return peaks + np.stack([offsets[row], offsets[col]], axis=1)
+
+
+def _lowpass(shape, cutoff):
+    """Gaussian weights on the rfft2 frequencies, cutoff in cycles per pixel."""
+    freq_y = fft.fftfreq(shape[0])[:, None]
+    freq_x = fft.rfftfreq(shape[1])[None, :]
+    return np.exp(-(freq_y ** 2 + freq_x ** 2) / (2 * cutoff ** 2)).astype(np.float32)
+
+
+# Translation of every image relative to the reference.
+def phase_correlation(reference, images, window=True, upsample_factor=20, lowpass=0.1):
+    """
+    Estimate the shift (dy, dx) of each image relative to reference.
+
+    An image with content at reference position (y, x) moved to (y + dy, x + dx)
+    gives (dy, dx), accurate to 1 / upsample_factor pixels. images has shape
+    (n, height, width) or (height, width), all FFTs of the batch run in one
+    multi-threaded call. Returns shape (n, 2).
+
+    lowpass (cycles per pixel, None to disable) damps the highest frequencies,
+    where scanner noise and resampling make the phase unreliable.
+    """
+    reference = np.asarray(reference, dtype=np.float32)
+    images = _as_stack(images, reference.shape)
+    taper = _window(reference.shape) if window else np.float32(1)
+
+    reference_spectrum = fft.rfft2((reference - reference.mean()) * taper, workers=-1)
+    spectra = fft.rfft2((images - images.mean(axis=(1, 2), keepdims=True)) * taper, axes=(1, 2), workers=-1)
+    cross_power = spectra * np.conj(reference_spectrum)[None]
+    cross_power /= np.abs(cross_power) + 1e-12
+    if lowpass:
+        cross_power *= _lowpass(reference.shape, lowpass)
+    correlation = fft.irfft2(cross_power, s=reference.shape, axes=(1, 2), workers=-1)
+    peaks = _integer_peaks(correlation)
+    if upsample_factor > 1:
+        peaks = _refine_peaks(cross_power, peaks, reference.shape, upsample_factor)
+    return peaks
+
+
+def _log_polar_spectra(images, num_angles, num_radii):
+    """Log-polar resampled, high-pass filtered magnitude spectra of a stack of images."""
+    _, height, width = images.shape
+    spectra = np.abs(fft.fftshift(fft.fft2(images * _window((height, width)), axes=(1, 2), workers=-1), axes=(1, 2)))
+
+    # high-pass filter, the low frequencies are the same for every page
+    freq_y = np.cos(np.pi * np.linspace(-0.5, 0.5, height))[:, None]
+    freq_x = np.cos(np.pi * np.linspace(-0.5, 0.5, width))[None, :]
+    highpass = 1 - freq_y * freq_x
+    spectra *= highpass * (2 - highpass)
+
+    # sample in cycles per pixel, so non-square pages rotate around a circle,
+    # the magnitude spectrum is point symmetric, half a turn holds all angles
+    min_frequency = 1 / min(height, width)
+    log_base = np.log(0.5 / min_frequency) / num_radii
+    frequencies = min_frequency * np.exp(np.arange(num_radii) * log_base)
+    angles = np.linspace(0, np.pi, num_angles, endpoint=False)
+    rows = height // 2 - frequencies[None, :] * np.sin(angles)[:, None] * height
+    cols = width // 2 + frequencies[None, :] * np.cos(angles)[:, None] * width
+    log_polar = np.stack([ndimage.map_coordinates(spectrum, [rows, cols], order=1) for spectrum in spectra])
+    return log_polar, log_base
+
+
+# Scale and rotation of every image relative to the reference.
+def scale_rotation(reference, images, num_angles=1440, num_radii=1024):
+    """
+    Estimate the scale and rotation (degrees, counter-clockwise) of each image
+    relative to reference from their magnitude spectra, independent of any
+    translation. Returns arrays of shape (n,).
+    """
+    reference = np.asarray(reference, dtype=np.float32)
+    images = _as_stack(images, reference.shape)
+    reference_log_polar, log_base = _log_polar_spectra(reference[None], num_angles, num_radii)
+    log_polar, _ = _log_polar_spectra(images, num_angles, num_radii)
+
+    shifts = phase_correlation(reference_log_polar[0], log_polar, window=False, lowpass=None)
+    angles = shifts[:, 0] * 180.0 / num_angles
+    # a larger page has a smaller spectrum
+    scales = np.exp(-shifts[:, 1] * log_base)
+    return scales, angles
+
+
+def _undo_scale_rotation(image, scale, angle):
+    """Resample image so that it has the scale and rotation of the reference again."""
+    center = (np.array(image.shape) - 1) / 2
+    theta = np.deg2rad(angle)
+    # output (reference) coordinates -> input (page) coordinates
+    matrix = scale * np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
+    offset = center - matrix @ center
+    return ndimage.affine_transform(image, matrix, offset=offset, order=1, mode='nearest')
+
+
+# Register a batch of pages against the reference template.
+def register_pages(template, pages, estimate_scale_rotation=False, batch_size=32):
+    """
+    Estimate the transform from the template to every page.
+
+    template is the page the fixed grid (table_rows/table_cols) was measured on,
+    pages are arrays of the same shape. Pages are processed batch_size at a
+    time to bound memory. Returns a list with one dict per page holding shift
+    (dy, dx) in pixels, scale and angle in degrees (1 and 0 unless
+    estimate_scale_rotation=True).
+    """
+    template = np.asarray(template, dtype=np.float32)
+    results = []
+    for start in range(0, len(pages), batch_size):
+        batch = _as_stack(pages[start:start + batch_size], template.shape)
+        if estimate_scale_rotation:
+            scales, angles = scale_rotation(template, batch)
+            corrected = np.stack([_undo_scale_rotation(page, scale, angle)
+                                  for page, scale, angle in zip(batch, scales, angles)])
+        else:
+            scales, angles = np.ones(len(batch)), np.zeros(len(batch))
+            corrected = batch
+        shifts = phase_correlation(template, corrected)
+        results.extend({'shift': (float(dy), float(dx)), 'scale': float(scale), 'angle': float(angle)}
+                       for (dy, dx), scale, angle in zip(shifts, scales, angles))
+    return results
+
+
+# Map the fixed grid coordinates onto a registered page.
+def page_grid(table_rows, table_cols, registration, shape):
+    """
+    Row and column positions of the fixed grid on one page.
+
+    registration is one entry of register_pages, shape the page shape. Scale
+    is applied around the page center like in the registration. A rotation
+    can not be expressed as row/column positions, deskew the pages first
+    (image_rotation_analysis) so the angle stays close to 0.
+    """
+    center_y, center_x = (np.array(shape) - 1) / 2
+    dy, dx = registration['shift']
+    scale = registration['scale']
+    rows = center_y + scale * (np.asarray(table_rows) - center_y) + dy
+    cols = center_x + scale * (np.asarray(table_cols) - center_x) + dx
+    return rows, cols
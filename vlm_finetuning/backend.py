@@ -0,0 +1,63 @@
+"""
+Device selection and CPU setup for inference
+
+On CPU-only nodes the model runs in float32 with dynamic int8 quantization of
+the linear layers. Several worker processes on one node should split the
+physical cores between them instead of each using all of them.
+"""
+
+import os
+
+import torch
+
+
+def select_device(device=None):
+    """The requested device, or the best available one: cuda, then mps, then cpu"""
+    if device is not None:
+        return torch.device(device)
+    if torch.cuda.is_available():
+        return torch.device("cuda")
+    if torch.backends.mps.is_available():
+        return torch.device("mps")
+    return torch.device("cpu")
+
+
+def physical_cores():
+    """Number of physical cores this process may run on"""
+    try:
+        import psutil
+
+        cores = psutil.cpu_count(logical=False)
+    except ImportError:
+        cores = None
+    if not cores:
+        cores = os.cpu_count()
+    if hasattr(os, "sched_getaffinity"):
+        # respect cpusets from the batch scheduler
+        cores = min(cores, len(os.sched_getaffinity(0)))
+    return cores
+
+
+def configure_cpu_threads(intra_op_threads=None, inter_op_threads=1, num_workers=1):
+    """
+    Set the torch thread pools for this process.
+
+    By default the physical cores are split evenly between num_workers worker
+    processes. Returns the number of intra-op threads used.
+    """
+    if intra_op_threads is None:
+        intra_op_threads = max(1, physical_cores() // num_workers)
+    torch.set_num_threads(intra_op_threads)
+    try:
+        torch.set_num_interop_threads(inter_op_threads)
+    except RuntimeError:
+        # can only be set once, before any inter-op parallel work has started
+        pass
+    return intra_op_threads
+
+
+def quantize_int8(model):
+    """Dynamic int8 quantization of all linear layers, for float32 models on CPU"""
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+    )
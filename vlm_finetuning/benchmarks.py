@@ -0,0 +1,553 @@
+"""
+Benchmarks for the cell reading paths
+
+Prefill time with and without the prefix KV cache, for the base model or a
+LoRA model:
+
+    python benchmarks.py prefill --model ./finetuned_qwen_models/lora_model_20250414_134955
+
+CPU throughput in cells/sec, with a small randomly initialised stand-in for
+Qwen2.5-VL so it runs on any machine:
+
+    python benchmarks.py cpu --tiny --threads 4
+
+End-to-end suite over the reading backends (inference, inference_batch,
+pipelined_inference, generate_description and EasyOCR) with p50/p95 latency, cells/sec, peak RSS
+and generated tokens, written to JSON. Each backend runs in its own process so
+that peak RSS is per backend. Only the processor is loaded from the hub
+(cache), so with --tiny it runs offline once that is cached:
+
+    python benchmarks.py suite --tiny --output results/HEAD.json
+    python benchmarks.py compare results/main.json results/HEAD.json
+"""
+
+import argparse
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image as PILImage
+
+from constants import SYSTEM_PROMPT, BASE_MODEL_ID, BATCH_SIZE
+from prefix_cache import PrefixCache
+from columnar_store import load_columns
+from prepare_data_qwen import prep_image, prepare_inference_sample
+
+
+def _timed(fn, device):
+    """Wall time of fn() in seconds, waiting for queued GPU work to finish"""
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return time.perf_counter() - start
+
+
+@torch.no_grad()
+def benchmark_prefill(model, tokenizer, list_of_image_bytes, system_prompt, warmup=2):
+    """
+    Per-cell prefill time with and without the prefix KV cache.
+
+    The first warmup cells are not counted, the first prefill with the cache
+    also computes the cached prefix.
+    """
+    messages = prepare_inference_sample(system_prompt, image_first=False)
+    input_text = tokenizer.apply_chat_template(messages, add_generation_prompt=True)
+    prefix_cache = PrefixCache(model)
+
+    times_without_cache = []
+    times_with_cache = []
+    for i, image_bytes in enumerate(list_of_image_bytes):
+        inputs = tokenizer(
+            prep_image(image_bytes),
+            input_text,
+            add_special_tokens=False,
+            return_tensors="pt",
+        ).to(model.device)
+
+        time_without_cache = _timed(
+            lambda: model(**inputs, use_cache=True), model.device
+        )
+        time_with_cache = _timed(lambda: prefix_cache.prefill(inputs), model.device)
+        if i >= warmup:
+            times_without_cache.append(time_without_cache)
+            times_with_cache.append(time_with_cache)
+
+    return {
+        "cells": len(times_with_cache),
+        "prompt_tokens": inputs["input_ids"].shape[1],
+        "prefix_tokens": prefix_cache.prefix_ids.shape[1],
+        "prefill_ms_without_cache": float(1000 * np.median(times_without_cache)),
+        "prefill_ms_with_cache": float(1000 * np.median(times_with_cache)),
+        "speedup": float(np.median(times_without_cache) / np.median(times_with_cache)),
+    }
+
+
+def benchmark_throughput(
+    model, tokenizer, list_of_image_bytes, system_prompt, batch_size=BATCH_SIZE
+):
+    """Cells per second of constrained batched inference, after one warmup batch"""
+    from qwen_helper_funcs import inference_batch
+
+    inference_batch(
+        model,
+        tokenizer,
+        list_of_image_bytes[:batch_size],
+        system_prompt,
+        batch_size,
+        constrained=True,
+    )
+    start = time.perf_counter()
+    inference_batch(
+        model,
+        tokenizer,
+        list_of_image_bytes,
+        system_prompt,
+        batch_size,
+        constrained=True,
+    )
+    elapsed = time.perf_counter() - start
+    return {
+        "cells": len(list_of_image_bytes),
+        "seconds": elapsed,
+        "cells_per_second": len(list_of_image_bytes) / elapsed,
+    }
+
+
+def _peak_rss_mb():
+    # ru_maxrss survives exec on Linux, so spawned processes would report the
+    # parent's peak, the high water mark in /proc starts fresh
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def benchmark_latency(read, inputs, warmup=2):
+    """
+    Latency of read(input) over inputs, the first warmup calls are not counted.
+
+    read returns the number of tokens it generated, or None if the backend has
+    no tokens (EasyOCR). inputs are single cells or batches of cells.
+    """
+    latencies = []
+    tokens = []
+    for i, item in enumerate(inputs):
+        start = time.perf_counter()
+        num_tokens = read(item)
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            latencies.append(elapsed)
+            tokens.append(num_tokens)
+
+    num_cells = sum(
+        len(item) if isinstance(item, list) else 1 for item in inputs[warmup:]
+    )
+    return {
+        "calls": len(latencies),
+        "cells": num_cells,
+        "p50_ms": float(1000 * np.percentile(latencies, 50)),
+        "p95_ms": float(1000 * np.percentile(latencies, 95)),
+        "cells_per_second": num_cells / sum(latencies),
+        "tokens_generated": None if None in tokens else int(sum(tokens)),
+    }
+
+
+def _description_backend(model, tokenizer, max_pixels):
+    # generate_description lives in the image_processing notebooks, which are not
+    # a package: load the file itself, so sys.path is left alone and no other
+    # model_utils module can shadow it
+    model_utils_path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "image_processing",
+        "notebooks",
+        "models",
+        "model_utils.py",
+    )
+    spec = importlib.util.spec_from_file_location(
+        "notebooks_model_utils", model_utils_path
+    )
+    model_utils = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(model_utils)
+    generate_description = model_utils.generate_description
+
+    tokenizer.image_processor.min_pixels = max_pixels
+    tokenizer.image_processor.max_pixels = max_pixels
+
+    def read(image_bytes):
+        image = np.asarray(prep_image(image_bytes).convert("L"), dtype=np.float32) / 255
+        output_text, _ = generate_description(image, model, tokenizer, SYSTEM_PROMPT)
+        # generate_description only returns text, count its tokens plus the end token
+        return len(tokenizer.tokenizer(output_text).input_ids) + 1
+
+    return read
+
+
+def run_backend(
+    backend,
+    list_of_image_bytes,
+    model_path=None,
+    tiny=True,
+    batch_size=BATCH_SIZE,
+    description_max_pixels=64 * 28 * 28,
+):
+    """
+    Benchmark one backend on the given cells.
+
+    backend is "inference" (one cell per call), "inference_batch",
+    "pipelined" (pipelined_inference), "description" (generate_description)
+    or "easyocr". The Qwen backends use the tiny random model unless
+    tiny=False, then load_model(model_path).
+
+    "pipelined" needs several batches to overlap, so after one warmup batch
+    it reads all cells in a single call (latency is that of the whole run),
+    and its per-stage seconds (stage_<name>_s) and bound_by are added.
+    """
+    from qwen_helper_funcs import inference, inference_batch, load_model
+    from pipeline import pipelined_inference, StageTimer
+
+    torch.manual_seed(0)
+    cells = list(list_of_image_bytes)
+    inputs = cells
+
+    if backend == "easyocr":
+        from easyocr_inference import inference_easyocr, get_reader
+
+        get_reader()
+
+        def read(image_bytes):
+            inference_easyocr(image_bytes)
+
+    else:
+        model, tokenizer = make_tiny_qwen() if tiny else load_model(model_path)
+
+        if backend == "inference":
+
+            def read(image_bytes):
+                _, scores = inference(
+                    model,
+                    tokenizer,
+                    image_bytes,
+                    SYSTEM_PROMPT,
+                    constrained=True,
+                    return_scores=True,
+                )
+                return len(scores["token_logprobs"])
+
+        elif backend == "inference_batch":
+            inputs = [
+                cells[start : start + batch_size]
+                for start in range(0, len(cells), batch_size)
+            ]
+
+            def read(batch):
+                _, scores = inference_batch(
+                    model,
+                    tokenizer,
+                    batch,
+                    SYSTEM_PROMPT,
+                    batch_size,
+                    constrained=True,
+                    return_scores=True,
+                )
+                return sum(len(score["token_logprobs"]) for score in scores)
+
+        elif backend == "pipelined":
+            inputs = [cells[:batch_size], cells]
+            timers = []
+
+            def read(batch):
+                timers.append(StageTimer())
+                _, scores = pipelined_inference(
+                    model,
+                    tokenizer,
+                    batch,
+                    SYSTEM_PROMPT,
+                    batch_size,
+                    constrained=True,
+                    return_scores=True,
+                    timer=timers[-1],
+                )
+                return sum(len(score["token_logprobs"]) for score in scores)
+
+        elif backend == "description":
+            read = _description_backend(model, tokenizer, description_max_pixels)
+        else:
+            raise ValueError(f"Unknown backend {backend}")
+
+    warmup = 1 if backend in ("inference_batch", "pipelined") else 2
+    results = benchmark_latency(read, inputs, warmup)
+    if backend == "pipelined":
+        stages = timers[-1].report()
+        results["bound_by"] = stages.pop("bound_by")
+        results.update({f"stage_{name}_s": value for name, value in stages.items()})
+    results["peak_rss_mb"] = _peak_rss_mb()
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(backends, list_of_image_bytes, isolate=True, **kwargs):
+    """
+    Run run_backend for every backend and collect the results with metadata.
+
+    With isolate=True each backend runs in a fresh process, so peak RSS is
+    measured per backend. A backend that fails (e.g. EasyOCR not installed)
+    is reported with its error instead of stopping the suite.
+    """
+    results = {}
+    for backend in backends:
+        print(f"Running {backend}")
+        try:
+            if isolate:
+                with multiprocessing.get_context("spawn").Pool(1) as pool:
+                    results[backend] = pool.apply(
+                        run_backend, (backend, list_of_image_bytes), kwargs
+                    )
+            else:
+                results[backend] = run_backend(backend, list_of_image_bytes, **kwargs)
+        except Exception as error:
+            results[backend] = {"error": f"{type(error).__name__}: {error}"}
+
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "threads": torch.get_num_threads(),
+            "cells": len(list_of_image_bytes),
+            **kwargs,
+        },
+        "results": results,
+    }
+
+
+# metrics where a larger value is a regression, cells_per_second is the other way round
+_LOWER_IS_BETTER = ["p50_ms", "p95_ms", "peak_rss_mb", "tokens_generated"]
+
+
+def compare_results(baseline, current, tolerance=0.1):
+    """
+    Regressions of current against baseline, as readable strings.
+
+    A metric regresses when it is more than tolerance (relative) worse.
+    Backends missing from either run are skipped.
+    """
+    regressions = []
+    for backend, new in current["results"].items():
+        old = baseline["results"].get(backend)
+        if old is None or "error" in old or "error" in new:
+            continue
+        for metric in _LOWER_IS_BETTER + ["cells_per_second"]:
+            if old.get(metric) is None or new.get(metric) is None or old[metric] == 0:
+                continue
+            change = (new[metric] - old[metric]) / old[metric]
+            if metric == "cells_per_second":
+                change = -change
+            if change > tolerance:
+                regressions.append(
+                    f"{backend} {metric}: {old[metric]:.2f} -> {new[metric]:.2f}"
+                )
+    return regressions
+
+
+def make_tiny_qwen(processor_id=BASE_MODEL_ID, seed=0):
+    """
+    Randomly initialised Qwen2.5-VL with a few small layers.
+
+    Uses the real processor, so tokenization and image preprocessing cost the
+    same as for the full model. Only meant for timing, its outputs are noise.
+    """
+    from transformers import (
+        AutoProcessor,
+        Qwen2_5_VLConfig,
+        Qwen2_5_VLForConditionalGeneration,
+    )
+
+    tokenizer = AutoProcessor.from_pretrained(processor_id)
+    token_id = tokenizer.tokenizer.convert_tokens_to_ids
+    config = Qwen2_5_VLConfig(
+        vocab_size=len(tokenizer.tokenizer),
+        image_token_id=token_id("<|image_pad|>"),
+        video_token_id=token_id("<|video_pad|>"),
+        vision_start_token_id=token_id("<|vision_start|>"),
+        vision_end_token_id=token_id("<|vision_end|>"),
+        hidden_size=128,
+        intermediate_size=256,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        rope_scaling={"type": "mrope", "mrope_section": [4, 6, 6]},
+        vision_config={
+            "depth": 2,
+            "hidden_size": 128,
+            "intermediate_size": 256,
+            "num_heads": 4,
+            "out_hidden_size": 128,
+            "fullatt_block_indexes": [1],
+        },
+    )
+    torch.manual_seed(seed)
+    model = Qwen2_5_VLForConditionalGeneration(config).eval()
+    model.generation_config.eos_token_id = token_id("<|im_end|>")
+    model.generation_config.pad_token_id = tokenizer.tokenizer.pad_token_id
+    model.cache_identity = f"tiny-qwen2.5-vl-{seed}"
+    return model, tokenizer
+
+
+def synthetic_cells(num_cells, seed=0, shape=(52, 88)):
+    """
+    Fixed set of cell images with grid borders and random strokes.
+
+    Encoded the same way as the cells in phenology_df.pkl, for benchmarks
+    that should run without the dataset.
+    """
+    rng = np.random.default_rng(seed)
+    cells = []
+    for _ in range(num_cells):
+        cell = np.full(shape, 235, dtype=np.uint8)
+        cell[:3, :] = cell[:, :3] = cell[-5:, :] = cell[:, -5:] = 0
+        for _ in range(rng.integers(0, 4)):
+            row = rng.integers(8, shape[0] - 22)
+            col = rng.integers(8, shape[1] - 12)
+            cell[row : row + 14, col : col + 3] = rng.integers(0, 60)
+        image_bytes = io.BytesIO()
+        PILImage.fromarray(cell).save(image_bytes, format="TIFF")
+        cells.append(image_bytes.getvalue())
+    return cells
+
+
+def _load_cells(args):
+    if args.data is None:
+        return synthetic_cells(args.num_cells)
+    df = load_columns(args.data, [args.column + "_image"])
+    return df[args.column + "_image"].values[: args.num_cells]
+
+
+def _print_results(results):
+    for name, value in results.items():
+        print(
+            f"{name}: {value:.2f}" if isinstance(value, float) else f"{name}: {value}"
+        )
+
+
+if __name__ == "__main__":
+    from qwen_helper_funcs import load_model
+    from backend import configure_cpu_threads, quantize_int8
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("benchmark", choices=["prefill", "cpu", "suite", "compare"])
+    parser.add_argument(
+        "files", nargs="*", help="compare: baseline and current results"
+    )
+    parser.add_argument("--model", default=None, help="path to a LoRA model")
+    parser.add_argument("--tiny", action="store_true", help="use a tiny random model")
+    parser.add_argument(
+        "--data",
+        default=None,
+        help="columnar store or dataset pickle, synthetic cells if not given",
+    )
+    parser.add_argument("--column", default="coltsfoot_flowering")
+    parser.add_argument("--num-cells", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--threads", type=int, default=None, help="intra-op threads")
+    parser.add_argument("--interop-threads", type=int, default=1)
+    parser.add_argument(
+        "--workers", type=int, default=1, help="workers sharing the cores"
+    )
+    parser.add_argument("--no-quantize", action="store_true")
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=["inference", "inference_batch", "pipelined", "description", "easyocr"],
+    )
+    parser.add_argument("--output", default=None, help="suite: JSON results file")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.benchmark == "compare":
+        baseline_path, current_path = args.files
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        with open(current_path) as f:
+            current = json.load(f)
+        regressions = compare_results(baseline, current, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        print(f"{len(regressions)} regressions")
+        sys.exit(1 if regressions else 0)
+
+    cells = _load_cells(args)
+
+    if args.benchmark == "suite":
+        suite = run_suite(
+            args.backends,
+            cells,
+            model_path=args.model,
+            tiny=args.tiny,
+            batch_size=args.batch_size,
+        )
+        for backend, results in suite["results"].items():
+            print(backend)
+            _print_results(results)
+        if args.output is not None:
+            if os.path.dirname(args.output):
+                os.makedirs(os.path.dirname(args.output), exist_ok=True)
+            with open(args.output, "w") as f:
+                json.dump(suite, f, indent=2)
+
+    elif args.benchmark == "prefill":
+        model, tokenizer = make_tiny_qwen() if args.tiny else load_model(args.model)
+        _print_results(benchmark_prefill(model, tokenizer, cells, SYSTEM_PROMPT))
+
+    else:
+        if args.tiny:
+            model, tokenizer = make_tiny_qwen()
+            if not args.no_quantize:
+                model = quantize_int8(model)
+        else:
+            model, tokenizer = load_model(
+                args.model, "cpu", not args.no_quantize, args.workers
+            )
+        threads = configure_cpu_threads(
+            args.threads, args.interop_threads, args.workers
+        )
+        print(f"CPU threads: {threads}, int8 quantization: {not args.no_quantize}")
+        _print_results(
+            benchmark_throughput(
+                model, tokenizer, cells, SYSTEM_PROMPT, args.batch_size
+            )
+        )
@@ -0,0 +1,180 @@
+"""
+Cascade from EasyOCR to the fine-tuned Qwen model
+
+EasyOCR reads every cell first. Its read is kept when it is confident and
+matches the cell grammar, all other cells are escalated to the Qwen model in
+batches. Most cells with one clearly written number never reach the VLM.
+"""
+
+import time
+
+import numpy as np
+
+from cell_grammar import CELL_PATTERN
+from constants import CASCADE_MIN_CONFIDENCE, CASCADE_ACCEPT_BLANK
+
+
+def accept_easyocr(prediction, confidence, min_confidence, accept_blank):
+    """Whether an EasyOCR read can be used without asking the Qwen model"""
+    prediction = prediction.strip()
+    if prediction == "":
+        return accept_blank
+    return (
+        confidence >= min_confidence and CELL_PATTERN.fullmatch(prediction) is not None
+    )
+
+
+def escalate(predictions, confidences, min_confidence, accept_blank):
+    """Boolean array that is True for the EasyOCR reads the Qwen model has to redo"""
+    return np.array(
+        [
+            not accept_easyocr(prediction, confidence, min_confidence, accept_blank)
+            for prediction, confidence in zip(predictions, confidences)
+        ],
+        dtype=bool,
+    )
+
+
+def cascade_inference(
+    model,
+    tokenizer,
+    list_of_image_bytes,
+    system_prompt,
+    min_confidence=CASCADE_MIN_CONFIDENCE,
+    accept_blank=CASCADE_ACCEPT_BLANK,
+    cache=None,
+    easyocr_workers=1,
+    **kwargs,
+):
+    """
+    Read cells with EasyOCR and escalate the uncertain ones to the Qwen model.
+
+    kwargs are passed to qwen_helper_funcs.inference_batch (e.g. constrained,
+    prefix_cache), easyocr_workers is the number of EasyOCR processes. Returns
+    the predictions in input order and a boolean array that is True for the
+    cells read by the Qwen model.
+    """
+    from easyocr_inference import inference_easyocr_batch
+    from qwen_helper_funcs import inference_batch
+
+    easyocr_predictions, confidences = inference_easyocr_batch(
+        list_of_image_bytes,
+        cache=cache,
+        return_confidence=True,
+        num_workers=easyocr_workers,
+    )
+    escalated = escalate(easyocr_predictions, confidences, min_confidence, accept_blank)
+    predictions = [prediction.strip() for prediction in easyocr_predictions]
+
+    rows = np.flatnonzero(escalated)
+    if len(rows) > 0:
+        qwen_predictions = inference_batch(
+            model,
+            tokenizer,
+            [list_of_image_bytes[i] for i in rows],
+            system_prompt,
+            cache=cache,
+            **kwargs,
+        )
+        for i, prediction in zip(rows, qwen_predictions):
+            predictions[i] = prediction
+    return predictions, escalated
+
+
+def evaluate_cascade(
+    model,
+    tokenizer,
+    list_of_image_bytes,
+    ground_truth,
+    system_prompt,
+    min_confidence=CASCADE_MIN_CONFIDENCE,
+    accept_blank=CASCADE_ACCEPT_BLANK,
+    measured_confidence=None,
+    easyocr_workers=1,
+    **kwargs,
+):
+    """
+    Compare the cascade with reading every cell with the Qwen model.
+
+    min_confidence can be a list of thresholds to sweep. EasyOCR and the Qwen
+    model read every cell once, without a prediction cache so that the timings
+    are real, and each threshold is evaluated on these reads: escalated cells
+    get the Qwen read. estimated_cascade_cells_per_sec counts the EasyOCR time
+    plus the Qwen time per cell for every escalated cell. Only the cascade at
+    measured_confidence (default: the first threshold) is also run for real,
+    its cascade_cells_per_sec is measured and None for the other thresholds.
+
+    Returns the fraction of cells escalated, cells/sec and accuracy of both,
+    as a list of reports for a list of thresholds.
+    """
+    from easyocr_inference import inference_easyocr_batch
+    from qwen_helper_funcs import inference_batch
+
+    ground_truth = np.asarray(ground_truth)
+    num_cells = len(list_of_image_bytes)
+    thresholds = [float(threshold) for threshold in np.atleast_1d(min_confidence)]
+    if measured_confidence is None:
+        measured_confidence = thresholds[0]
+    if measured_confidence not in thresholds:
+        raise ValueError(f"measured_confidence {measured_confidence} is not swept")
+
+    start = time.perf_counter()
+    easyocr_predictions, confidences = inference_easyocr_batch(
+        list_of_image_bytes, return_confidence=True, num_workers=easyocr_workers
+    )
+    easyocr_seconds = time.perf_counter() - start
+    easyocr_predictions = np.array(
+        [prediction.strip() for prediction in easyocr_predictions]
+    )
+
+    start = time.perf_counter()
+    qwen_predictions = np.array(
+        inference_batch(model, tokenizer, list_of_image_bytes, system_prompt, **kwargs)
+    )
+    qwen_seconds = time.perf_counter() - start
+
+    # one real cascade pass, after the Qwen pass so the model is warm
+    start = time.perf_counter()
+    cascade_inference(
+        model,
+        tokenizer,
+        list_of_image_bytes,
+        system_prompt,
+        measured_confidence,
+        accept_blank,
+        easyocr_workers=easyocr_workers,
+        **kwargs,
+    )
+    measured_seconds = time.perf_counter() - start
+
+    reports = []
+    for threshold in thresholds:
+        escalated = escalate(easyocr_predictions, confidences, threshold, accept_blank)
+        cascade_predictions = np.where(escalated, qwen_predictions, easyocr_predictions)
+        estimated_seconds = easyocr_seconds + qwen_seconds * float(escalated.mean())
+        accepted = ~escalated
+        reports.append(
+            {
+                "min_confidence": threshold,
+                "accept_blank": accept_blank,
+                "escalated_fraction": float(escalated.mean()),
+                "cascade_cells_per_sec": (
+                    num_cells / measured_seconds
+                    if threshold == measured_confidence
+                    else None
+                ),
+                "estimated_cascade_cells_per_sec": num_cells / estimated_seconds,
+                "cascade_accuracy": float(np.mean(cascade_predictions == ground_truth)),
+                "qwen_cells_per_sec": num_cells / qwen_seconds,
+                "qwen_accuracy": float(np.mean(qwen_predictions == ground_truth)),
+                # accuracy of the reads EasyOCR kept, shows whether min_confidence is too low
+                "accepted_accuracy": (
+                    float(
+                        np.mean(cascade_predictions[accepted] == ground_truth[accepted])
+                    )
+                    if accepted.any()
+                    else None
+                ),
+            }
+        )
+    return reports if np.ndim(min_confidence) else reports[0]
@@ -0,0 +1,161 @@
+"""
+Compact encoding of the cell images in the *_image columns
+
+img_to_bytes used to store every cell as an uncompressed TIFF, and every reader
+decoded it with PIL. Cells are single channel uint8, so they are stored as
+one of:
+
+- "png" or "webp": lossless grayscale, the smallest blobs
+- "raw": a small header followed by the pixels, decoded with np.frombuffer
+  without copying, the fastest to read
+
+decode_cell reads all of these and the old TIFF blobs, so existing pickles keep
+working. Run this file to migrate a pickle and report the size reduction and
+decode throughput, e.g.
+
+    python cell_codec.py data/phenology_df.pkl data/phenology_df_png.pkl --format png
+"""
+
+import argparse
+import io
+import struct
+import time
+
+import numpy as np
+import pandas as pd
+from PIL import Image as PILImage
+
+from constants import CELL_CODEC_FORMAT
+
+RAW_MAGIC = b"CEL1"
+# magic, height and width as little endian uint16
+RAW_HEADER = struct.Struct("<4sHH")
+FORMATS = ("raw", "png", "webp")
+
+
+def _to_uint8(cell):
+    # float cells are 0...1 like the crops img_to_bytes takes
+    cell = np.asarray(cell)
+    if cell.dtype != np.uint8:
+        cell = (255 * cell).astype(np.uint8)
+    if cell.ndim == 3:
+        cell = np.asarray(PILImage.fromarray(cell).convert("L"))
+    return cell
+
+
+def encode_cell(cell, format=CELL_CODEC_FORMAT):
+    """Encode a 2D uint8 (or 0...1 float) cell as bytes"""
+    cell = _to_uint8(cell)
+    if format == "raw":
+        height, width = cell.shape
+        return (
+            RAW_HEADER.pack(RAW_MAGIC, height, width)
+            + np.ascontiguousarray(cell).tobytes()
+        )
+    if format not in FORMATS:
+        raise ValueError(f"Unknown cell format {format}, use one of {FORMATS}")
+    image_bytes = io.BytesIO()
+    options = {"lossless": True} if format == "webp" else {"optimize": True}
+    PILImage.fromarray(cell).save(image_bytes, format=format.upper(), **options)
+    return image_bytes.getvalue()
+
+
+def is_raw(image_bytes):
+    return image_bytes[:4] == RAW_MAGIC
+
+
+def decode_cell(image_bytes):
+    """
+    Decode a cell to a 2D uint8 array.
+
+    Raw cells are a read-only view of image_bytes, everything else (PNG, WebP
+    and the old TIFF blobs) is decoded with PIL.
+    """
+    if is_raw(image_bytes):
+        _, height, width = RAW_HEADER.unpack_from(image_bytes)
+        return np.frombuffer(
+            image_bytes, dtype=np.uint8, count=height * width, offset=RAW_HEADER.size
+        ).reshape(height, width)
+    return np.asarray(PILImage.open(io.BytesIO(image_bytes)).convert("L"))
+
+
+def to_pil(image_bytes):
+    """Cell as a PIL image, grayscale for raw cells, as stored otherwise"""
+    if is_raw(image_bytes):
+        return PILImage.fromarray(decode_cell(image_bytes))
+    return PILImage.open(io.BytesIO(image_bytes))
+
+
+def encode_cells(cells, format=CELL_CODEC_FORMAT):
+    return [encode_cell(cell, format) for cell in cells]
+
+
+def decode_cells(list_of_image_bytes):
+    return [decode_cell(image_bytes) for image_bytes in list_of_image_bytes]
+
+
+def image_columns(df):
+    return [col for col in df.columns if col.endswith("_image")]
+
+
+def migrate_dataframe(df, format=CELL_CODEC_FORMAT):
+    """Re-encode every *_image column of df in place"""
+    for col in image_columns(df):
+        df[col] = [
+            encode_cell(decode_cell(image_bytes), format) for image_bytes in df[col]
+        ]
+    return df
+
+
+def codec_report(list_of_image_bytes, formats=FORMATS):
+    """
+    Total size and decode throughput of the cells as stored and in every format.
+
+    Returns a DataFrame with one row per format. Decoding is timed on the
+    uint8 arrays that decode_cell returns.
+    """
+    cells = decode_cells(list_of_image_bytes)
+    encodings = {"stored": list(list_of_image_bytes)}
+    encodings.update({format: encode_cells(cells, format) for format in formats})
+    stored_size = sum(len(image_bytes) for image_bytes in encodings["stored"])
+
+    rows = []
+    for name, blobs in encodings.items():
+        start = time.perf_counter()
+        decoded = decode_cells(blobs)
+        elapsed = time.perf_counter() - start
+        assert all(np.array_equal(a, b) for a, b in zip(decoded, cells)), name
+        size = sum(len(image_bytes) for image_bytes in blobs)
+        rows.append(
+            {
+                "format": name,
+                "megabytes": size / 1e6,
+                "size_ratio": size / stored_size,
+                "decode_cells_per_sec": len(blobs) / max(elapsed, 1e-9),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def migrate_pickle(source, destination, format=CELL_CODEC_FORMAT, report_sample=2000):
+    """
+    Re-encode the *_image columns of the pickled DataFrame at source and write
+    it to destination. Returns codec_report on up to report_sample cells.
+    """
+    df = pd.read_pickle(source)
+    sample = np.concatenate([df[col].values for col in image_columns(df)])
+    sample = sample[np.random.default_rng(0).permutation(len(sample))[:report_sample]]
+    report = codec_report(sample)
+    migrate_dataframe(df, format).to_pickle(destination)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("source", help="pickled DataFrame with *_image columns")
+    parser.add_argument("destination", help="where to write the migrated pickle")
+    parser.add_argument("--format", choices=FORMATS, default=CELL_CODEC_FORMAT)
+    args = parser.parse_args()
+
+    report = migrate_pickle(args.source, args.destination, args.format)
+    print(report.to_string(index=False, float_format="%.3f"))
@@ -0,0 +1,103 @@
+"""
+Grammar of valid cell reads and a logits processor that enforces it
+
+A cell contains 1-3 digits, optionally in () or [], one of the letters e, s, k,
+the percent sign, or nothing (the model answers "unknown"), see SYSTEM_PROMPT.
+The processor only allows tokens that keep the generated text a prefix of a
+valid answer, and only allows the end of sequence once the answer is complete.
+"""
+
+import re
+from itertools import product
+
+import torch
+from transformers import LogitsProcessor
+
+CELL_PATTERN = re.compile(r"\d{1,3}|\(\d{1,3}\)|\[\d{1,3}\]|[esk%]|unknown")
+
+
+def _valid_outputs():
+    numbers = [
+        "".join(digits)
+        for num_digits in range(1, 4)
+        for digits in product("0123456789", repeat=num_digits)
+    ]
+    outputs = set(numbers)
+    outputs.update(f"({number})" for number in numbers)
+    outputs.update(f"[{number}]" for number in numbers)
+    outputs.update(["e", "s", "k", "%", "unknown"])
+    return frozenset(outputs)
+
+
+VALID_OUTPUTS = _valid_outputs()
+VALID_PREFIXES = frozenset(
+    output[:end] for output in VALID_OUTPUTS for end in range(len(output) + 1)
+)
+MAX_OUTPUT_LENGTH = max(len(output) for output in VALID_OUTPUTS)
+
+_GRAMMAR_CHARS = set("".join(VALID_OUTPUTS))
+_token_strings_cache = {}
+
+
+def _grammar_token_strings(tokenizer):
+    """Map the id of every token that can appear in a valid answer to its text"""
+    cache_key = (tokenizer.name_or_path, len(tokenizer))
+    if cache_key not in _token_strings_cache:
+        texts = tokenizer.batch_decode(
+            [[token_id] for token_id in range(len(tokenizer))]
+        )
+        _token_strings_cache[cache_key] = {
+            token_id: text
+            for token_id, text in enumerate(texts)
+            if 0 < len(text) <= MAX_OUTPUT_LENGTH and set(text) <= _GRAMMAR_CHARS
+        }
+    return _token_strings_cache[cache_key]
+
+
+class CellGrammarLogitsProcessor(LogitsProcessor):
+    """
+    Restrict generation to VALID_OUTPUTS followed by an end of sequence token.
+
+    prompt_length is the (padded) length of the prompt, everything after it in
+    input_ids is generated text. Works for batches, every row is tracked
+    separately.
+    """
+
+    def __init__(self, tokenizer, prompt_length, eos_token_ids):
+        tokenizer = getattr(tokenizer, "tokenizer", tokenizer)
+        self.token_strings = _grammar_token_strings(tokenizer)
+        self.prompt_length = prompt_length
+        self.eos_token_ids = set(eos_token_ids)
+        self._allowed_cache = {}
+
+    def _allowed_tokens(self, prefix, device):
+        if prefix not in self._allowed_cache:
+            allowed = [
+                token_id
+                for token_id, text in self.token_strings.items()
+                if prefix + text in VALID_PREFIXES
+            ]
+            if prefix in VALID_OUTPUTS:
+                allowed.extend(self.eos_token_ids)
+            self._allowed_cache[prefix] = torch.tensor(allowed, dtype=torch.long)
+        return self._allowed_cache[prefix].to(device)
+
+    def __call__(self, input_ids, scores):
+        mask = torch.full_like(scores, float("-inf"))
+        for row, generated in enumerate(input_ids[:, self.prompt_length :].tolist()):
+            if self.eos_token_ids.intersection(generated):
+                # finished rows are padded by generate, leave their scores alone
+                mask[row] = 0
+                continue
+            prefix = "".join(self.token_strings[token_id] for token_id in generated)
+            mask[row, self._allowed_tokens(prefix, scores.device)] = 0
+        return scores + mask
+
+
+def eos_token_ids(model, tokenizer):
+    """All token ids that end generation for this model"""
+    eos = model.generation_config.eos_token_id
+    eos = set(eos) if isinstance(eos, (list, tuple)) else {eos}
+    eos.add(getattr(tokenizer, "tokenizer", tokenizer).eos_token_id)
+    eos.discard(None)
+    return eos
@@ -0,0 +1,225 @@
+"""
+Columnar storage of the phenology dataset, read one column at a time
+
+phenology_df.pkl holds the metadata and hundreds of *_image byte columns, and
+pd.read_pickle loads all of them even when a script needs a handful. A
+columnar store is a directory with
+
+- table.parquet: every column except the images, read with projection
+  pushdown so only the requested columns are decoded
+- images.bin: the image bytes, one contiguous chunk per *_image column
+- image_offsets.npy: (num_image_columns, num_rows + 1) offsets of every image
+  in images.bin, memory-mapped
+- meta.json: number of rows and the column names
+
+load_columns returns the requested columns only. Image columns are
+ImageColumn objects that read an image from images.bin when it is accessed, so
+load time and memory scale with the cells actually used. They support what
+the scripts do with the pickled DataFrame columns: len, iteration, .values,
+.tolist() and indexing with an int, a slice or a list of rows.
+
+Run this file to convert a pickle, e.g.
+
+    python columnar_store.py data/phenology_df.pkl data/phenology
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+TABLE_FILE = "table.parquet"
+IMAGES_FILE = "images.bin"
+OFFSETS_FILE = "image_offsets.npy"
+META_FILE = "meta.json"
+
+
+def _object_array(items):
+    # np.array would turn a list of bytes into a fixed width bytes array
+    array = np.empty(len(items), dtype=object)
+    array[:] = items
+    return array
+
+
+def write_columnar(df, path):
+    """Write df to a columnar store at path, *_image columns go to images.bin"""
+    image_columns = [col for col in df.columns if col.endswith("_image")]
+    table_columns = [col for col in df.columns if col not in image_columns]
+    os.makedirs(path, exist_ok=True)
+
+    df[table_columns].to_parquet(os.path.join(path, TABLE_FILE))
+
+    offsets = np.zeros((len(image_columns), len(df) + 1), dtype=np.int64)
+    position = 0
+    with open(os.path.join(path, IMAGES_FILE), "wb") as f:
+        for i, col in enumerate(image_columns):
+            for row, image_bytes in enumerate(df[col]):
+                f.write(image_bytes)
+                position += len(image_bytes)
+                offsets[i, row + 1] = position
+            if i + 1 < len(image_columns):
+                offsets[i + 1, 0] = position
+    np.save(os.path.join(path, OFFSETS_FILE), offsets)
+
+    with open(os.path.join(path, META_FILE), "w") as f:
+        json.dump(
+            {
+                "num_rows": len(df),
+                "columns": list(df.columns),
+                "table_columns": table_columns,
+                "image_columns": image_columns,
+            },
+            f,
+        )
+
+
+class ImageColumn:
+    """Image bytes of one *_image column, read from images.bin on access"""
+
+    def __init__(self, path, column_index, num_rows):
+        self.path = path
+        self.column_index = column_index
+        self.num_rows = num_rows
+        self._blobs = None
+        self._offsets = None
+
+    def _open(self):
+        if self._blobs is None:
+            offsets = np.load(os.path.join(self.path, OFFSETS_FILE), mmap_mode="r")
+            self._offsets = np.asarray(offsets[self.column_index])
+            blobs_path = os.path.join(self.path, IMAGES_FILE)
+            if os.path.getsize(blobs_path) > 0:
+                self._blobs = np.memmap(blobs_path, dtype=np.uint8, mode="r")
+            else:
+                self._blobs = np.zeros(0, dtype=np.uint8)
+
+    def __getstate__(self):
+        # data loader workers reopen images.bin instead of receiving a copy of it
+        state = self.__dict__.copy()
+        state["_blobs"] = state["_offsets"] = None
+        return state
+
+    def _read(self, row):
+        if row < 0:
+            row += self.num_rows
+        if not 0 <= row < self.num_rows:
+            raise IndexError(f"row {row} out of range for {self.num_rows} rows")
+        self._open()
+        return self._blobs[self._offsets[row] : self._offsets[row + 1]].tobytes()
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self._read(int(key))
+        if isinstance(key, slice):
+            rows = range(*key.indices(self.num_rows))
+        else:
+            rows = np.arange(self.num_rows)[np.asarray(key)]
+        return _object_array([self._read(int(row)) for row in rows])
+
+    def __iter__(self):
+        return (self._read(row) for row in range(self.num_rows))
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:]
+
+    @property
+    def values(self):
+        # indexing .values stays lazy, like indexing the column itself
+        return self
+
+    def tolist(self):
+        return list(self)
+
+
+class ColumnarDataset:
+    """The requested columns of a columnar store, images are ImageColumn objects"""
+
+    def __init__(self, path, columns=None):
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        self.path = path
+        self.num_rows = meta["num_rows"]
+        available = meta["columns"]
+        self.columns = list(available if columns is None else columns)
+        missing = [col for col in self.columns if col not in available]
+        if missing:
+            raise KeyError(f"Columns not in {path}: {missing}")
+
+        table_columns = [col for col in self.columns if col in meta["table_columns"]]
+        self.table = pd.read_parquet(
+            os.path.join(path, TABLE_FILE), columns=table_columns
+        )
+        self.images = {
+            col: ImageColumn(path, meta["image_columns"].index(col), self.num_rows)
+            for col in self.columns
+            if col in meta["image_columns"]
+        }
+
+    def __len__(self):
+        return self.num_rows
+
+    def __contains__(self, column):
+        return column in self.columns
+
+    def __getitem__(self, column):
+        if column in self.images:
+            return self.images[column]
+        if column in self.table.columns:
+            return self.table[column]
+        raise KeyError(column)
+
+    def to_pandas(self):
+        """All requested columns as a DataFrame, this reads every image"""
+        df = self.table.copy()
+        for col, images in self.images.items():
+            df[col] = images[:]
+        return df[self.columns]
+
+
+def load_columns(path, columns=None, lazy=True):
+    """
+    Load the given columns (default: all) of the dataset at path.
+
+    path is a columnar store directory or, for older datasets, a pickled
+    DataFrame, which is read whole. With lazy=True a columnar store returns a
+    ColumnarDataset that reads images on access, otherwise a DataFrame.
+    """
+    if os.path.isfile(path):
+        df = pd.read_pickle(path)
+        return df if columns is None else df[list(columns)]
+    if not os.path.exists(os.path.join(path, META_FILE)):
+        raise FileNotFoundError(
+            f"No columnar store at {path}, convert the pickle with columnar_store.py"
+        )
+    dataset = ColumnarDataset(path, columns)
+    return dataset if lazy else dataset.to_pandas()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("source", help="pickled DataFrame, e.g. data/phenology_df.pkl")
+    parser.add_argument("destination", help="directory of the columnar store")
+    args = parser.parse_args()
+
+    write_columnar(pd.read_pickle(args.source), args.destination)
+
+    start = time.perf_counter()
+    df = pd.read_pickle(args.source)
+    column = next(col for col in df.columns if col.endswith("_image"))
+    images = list(df[column])
+    pickle_time = time.perf_counter() - start
+    del df
+
+    start = time.perf_counter()
+    images = list(load_columns(args.destination, [column])[column])
+    columnar_time = time.perf_counter() - start
+    print(
+        f"Loading {column}: {pickle_time:.2f}s from the pickle, "
+        f"{columnar_time:.2f}s from the columnar store"
+    )
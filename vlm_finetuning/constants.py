@@ -1,6 +1,66 @@
+BASE_MODEL_ID = "unsloth/Qwen2.5-VL-7B-Instruct"
+
 TEMPERATURE = 0.1
 MIN_P = 0.95
 MAX_NEW_TOKENS = 16
+GRAMMAR_MAX_NEW_TOKENS = 8  # longest valid cell read is "unknown" plus end of sequence
+BATCH_SIZE = 16  # number of cell images per model.generate call
+# predictions with a sequence logprob below this (probability ~0.6) are flagged for review
+LOW_CONFIDENCE_LOGPROB = -0.5
+
+# blank cell prefilter, see blank_filter.py
+# rows (columns) at a cell edge with more ink than this fraction of their length are ruling lines
+BORDER_LINE_FRACTION = 0.8
+# ruling lines are searched this far into the cell from each edge
+BORDER_BAND_FRACTION = 0.25
+INK_THRESHOLD = 128  # grayscale values below this count as ink
+MIN_COMPONENT_SIZE = 12  # connected ink blobs smaller than this are treated as specks
+MAX_BLANK_INK_FRACTION = 0.002  # cells with more ink than this are never skipped
+
+# vision token budget, see vision_budget.py
+CROP_PADDING = 4  # pixels of paper kept around the ink when cropping a cell
+MIN_CROP_SIZE = 28  # the processor needs at least one 28 pixel patch per side
+# pixel budgets tried for cropped cells, 28 * 28 pixels make one vision token
+PIXEL_BUDGETS = [tokens * 28 * 28 for tokens in (4, 8, 16, 32, 64)]
+
+# EasyOCR, see easyocr_inference.py
+EASYOCR_ALLOWLIST = "0123456789()[]esk%"  # every character that can appear in a cell
+EASYOCR_BATCH_SIZE = 32
+
+# EasyOCR -> Qwen cascade, see cascade.py
+CASCADE_MIN_CONFIDENCE = 0.9  # EasyOCR reads below this confidence go to Qwen
+# EasyOCR misses faint ink, so its blank reads go to Qwen too
+CASCADE_ACCEPT_BLANK = False
+
+# cell image encoding, see cell_codec.py
+CELL_CODEC_FORMAT = "png"  # "png", "webp" (lossless) or "raw" (fastest to decode)
+
+# columnar store of phenology_df.pkl written by columnar_store.py
+PHENOLOGY_DATASET_PATH = "data/phenology"
+# labels keyed by (table_id, field), see label_store.py
+LABEL_STORE_PATH = "data/labels.sqlite"
+PREDICTION_CACHE_PATH = "data/prediction_cache.sqlite"
+# preprocessed fine-tuning samples, see vision_cache.py
+VISION_CACHE_DIR = "data/vision_cache"
+RUN_JOURNAL_DIR = "runs"  # append-only journals of extraction runs, see run_journal.py
+
+# pipelined inference, see pipeline.py
+PIPELINE_WORKERS = 4  # threads preparing batches while the model runs
+PIPELINE_PREFETCH = 4  # prepared batches held in memory at most
+
+# CPU inference, see backend.py
+CPU_QUANTIZE = True  # dynamic int8 quantization of the linear layers
+# intra-op threads per process, None splits the physical cores between the workers
+CPU_THREADS = None
+CPU_INTEROP_THREADS = 1
+
+# sharded extraction, see sharded_extraction.py
+# fields that are not cell reads
+METADATA_FIELDS = ["number", "location", "county", "position", "hasl", "ds"]
+SHARD_ROWS = 70  # rows of one column per shard
+CLAIM_HEARTBEAT_SECONDS = 60  # claim files are touched this often while a shard runs
+# shards whose claim has not been touched for this long are handed out again
+STALE_CLAIM_SECONDS = 10 * 60
 
 
 SYSTEM_PROMPT = """
@@ -30,3 +90,18 @@ Instructions:
     - Do not use any code formatting, backticks, or markdown in your response. Just output the raw text.
     - Respond **ONLY** with the string. Do not provide explanations or reasoning.
 """
+
+# For cells whose ruling lines were removed with strip_borders (image_processing/notebooks/utils),
+# the instructions about borders are not needed. Models fine-tuned with SYSTEM_PROMPT need to be
+# fine-tuned again with this prompt before it is used for inference.
+SYSTEM_PROMPT_STRIPPED = """
+You are an expert at reading handwritten table entries. Read the text in the table cell and return it as a string.
+
+The text is one of:
+1) A number with 1 to 3 digits, optionally in ordinary parenthesis or square brackets.
+2) The letter 'e', 's' or 'k', or the percent sign '%'.
+3) No text at all (blank image), then return: "unknown".
+
+A 7 always has a horizontal stroke in the middle, without it the digit is a 1.
+Respond **ONLY** with the raw string, no formatting or explanations.
+"""
@@ -1,19 +1,183 @@
 """
 Do inference with EasyOCR
+
+The reader is only built on first use and is then reused by the process, so
+importing this module is cheap. inference_easyocr_batch reads many cells per
+call, restricted to the characters that can appear in a cell, and can spread
+the work over several processes on CPU nodes.
 """
 
-import pandas as pd
-import easyocr
+import json
+import multiprocessing
+from functools import lru_cache
+
 import numpy as np
+import torch
 from qwen_helper_funcs import prep_image
+from cell_codec import decode_cells
+from constants import EASYOCR_ALLOWLIST, EASYOCR_BATCH_SIZE
+from backend import configure_cpu_threads
+
+EASYOCR_MODEL_ID = "easyocr-en"
+
+
+@lru_cache(maxsize=None)
+def get_reader(gpu=None):
+    """EasyOCR reader, built on the first call and cached for this process"""
+    import easyocr
+
+    if gpu is None:
+        gpu = torch.cuda.is_available()
+    return easyocr.Reader(["en"], gpu=gpu)
+
+
+def _read_result(result):
+    # the confidence only means something when EasyOCR found exactly one piece of text
+    prediction = result[0][1] if len(result) > 0 else ""
+    confidence = float(result[0][2]) if len(result) == 1 else 0.0
+    return prediction, confidence
+
+
+def _cache_key(cache, image_bytes, allowlist, return_confidence):
+    params = {"detail": 1 if return_confidence else 0}
+    if allowlist is not None:
+        params["allowlist"] = allowlist
+    return cache.make_key(image_bytes, EASYOCR_MODEL_ID, "", params)
+
+
+def _cache_value(prediction, confidence, return_confidence):
+    return json.dumps([prediction, confidence]) if return_confidence else prediction
+
+
+def _from_cache(value, return_confidence):
+    return tuple(json.loads(value)) if return_confidence else value
 
-reader = easyocr.Reader(["en"])
 
+def inference_easyocr(
+    image_bytes,
+    display_image=False,
+    cache=None,
+    return_confidence=False,
+    allowlist=EASYOCR_ALLOWLIST,
+):
+    """
+    Read one cell image, cache is an optional prediction_cache.PredictionCache.
+
+    With return_confidence=True a (prediction, confidence) tuple is returned.
+    The confidence is EasyOCR's score when it found exactly one piece of text,
+    and 0 when it found none or several (the read is then ambiguous).
+    allowlist restricts the characters EasyOCR can read, None allows all.
+    """
+    if cache is not None:
+        key = _cache_key(cache, image_bytes, allowlist, return_confidence)
+        cached = cache.get(key)
+        if cached is not None:
+            return _from_cache(cached, return_confidence)
 
-def inference_easyocr(image_bytes, display_image=False):
     pil_image = prep_image(image_bytes)
     image_array = np.array(pil_image)
-    result = reader.readtext(image_array, detail=0)
+    result = get_reader().readtext(image_array, detail=1, allowlist=allowlist)
     if display_image:
         pil_image.show()
-    return result[0] if len(result) > 0 else ""
+    prediction, confidence = _read_result(result)
+
+    if cache is not None:
+        cache.put(key, _cache_value(prediction, confidence, return_confidence))
+    if return_confidence:
+        return prediction, confidence
+    return prediction
+
+
+def _pad_to_same_size(image_arrays):
+    """Pad cells with white at the bottom and right, EasyOCR batches need one image size"""
+    height = max(image.shape[0] for image in image_arrays)
+    width = max(image.shape[1] for image in image_arrays)
+    padded = []
+    for image in image_arrays:
+        padding = [(0, height - image.shape[0]), (0, width - image.shape[1])]
+        padding += [(0, 0)] * (image.ndim - 2)
+        padded.append(np.pad(image, padding, constant_values=255))
+    return padded
+
+
+def _read_batched(list_of_image_bytes, batch_size, allowlist):
+    image_arrays = decode_cells(list_of_image_bytes)
+    results = []
+    for start in range(0, len(image_arrays), batch_size):
+        batch = _pad_to_same_size(image_arrays[start : start + batch_size])
+        results.extend(
+            get_reader().readtext_batched(
+                batch, batch_size=batch_size, detail=1, allowlist=allowlist
+            )
+        )
+    return [_read_result(result) for result in results]
+
+
+def _init_worker(num_workers):
+    configure_cpu_threads(num_workers=num_workers)
+
+
+def inference_easyocr_batch(
+    list_of_image_bytes,
+    batch_size=EASYOCR_BATCH_SIZE,
+    allowlist=EASYOCR_ALLOWLIST,
+    cache=None,
+    return_confidence=False,
+    num_workers=1,
+):
+    """
+    Read many cell images, batch_size cells per EasyOCR call.
+
+    Returns the predictions in input order, or (predictions, confidences) with
+    return_confidence=True. With num_workers > 1 the cells are split between
+    that many processes, each with its own reader and an equal share of the
+    physical cores, which is faster than one process on CPU nodes.
+    """
+    if cache is not None:
+        keys = [
+            _cache_key(cache, image_bytes, allowlist, return_confidence)
+            for image_bytes in list_of_image_bytes
+        ]
+        cached = cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        if missing:
+            predictions, confidences = inference_easyocr_batch(
+                [list_of_image_bytes[i] for i in missing],
+                batch_size,
+                allowlist,
+                return_confidence=True,
+                num_workers=num_workers,
+            )
+            new_values = [
+                (keys[i], _cache_value(prediction, confidence, return_confidence))
+                for i, prediction, confidence in zip(missing, predictions, confidences)
+            ]
+            cache.put_many(new_values)
+            cached.update(new_values)
+        results = [_from_cache(cached[key], return_confidence) for key in keys]
+        if return_confidence:
+            return [result[0] for result in results], [result[1] for result in results]
+        return results
+
+    if num_workers > 1 and len(list_of_image_bytes) > batch_size:
+        chunk_size = -(-len(list_of_image_bytes) // num_workers)
+        chunks = [
+            list_of_image_bytes[start : start + chunk_size]
+            for start in range(0, len(list_of_image_bytes), chunk_size)
+        ]
+        # spawn, forked workers would inherit the torch thread pools of this process
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(
+            num_workers, initializer=_init_worker, initargs=(num_workers,)
+        ) as pool:
+            chunk_results = pool.starmap(
+                _read_batched, [(chunk, batch_size, allowlist) for chunk in chunks]
+            )
+        results = [result for chunk in chunk_results for result in chunk]
+    else:
+        results = _read_batched(list_of_image_bytes, batch_size, allowlist)
+
+    predictions = [prediction for prediction, _ in results]
+    if return_confidence:
+        return predictions, [confidence for _, confidence in results]
+    return predictions
@@ -5,7 +5,7 @@ I recommend running this file as an interactive window first
 """
 
 from qwen_helper_funcs import inference
-from constants import SYSTEM_PROMPT
+from constants import SYSTEM_PROMPT, PHENOLOGY_DATASET_PATH, VISION_CACHE_DIR
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
@@ -15,7 +15,11 @@ from unsloth import is_bf16_supported
 from unsloth.trainer import UnslothVisionDataCollator
 from trl import SFTTrainer, SFTConfig
 from datetime import datetime
+import os
 from prepare_data_qwen import prepare_dataset, make_labelled_df
+from prediction_cache import PredictionCache
+from columnar_store import load_columns
+from vision_cache import build_vision_cache, CachedVisionCollator
 
 # from PIL import Image as PILImage
 from constants import SYSTEM_PROMPT
@@ -23,6 +27,7 @@ import pandas as pd
 
 
 DATASET_PATH = "data/df_labelled_all.pkl"  # TODO update this to your own path
+USE_VISION_CACHE = True  # preprocess the images once instead of every epoch
 
 
 train_columns = [
@@ -44,8 +49,8 @@ test_columns = [
 ]
 
 
-all_columns = train_columns + test_columns
-make_labelled_df(all_columns)
+# the evaluation below reads the test columns from df_labelled_all.pkl
+make_labelled_df(labeled_columns=test_columns)
 
 
 r_value = 16
@@ -76,14 +81,28 @@ model = FastVisionModel.get_peft_model(
 )
 
 
-df = pd.read_pickle(DATASET_PATH)
-
-converted_dataset = prepare_dataset(DATASET_PATH, SYSTEM_PROMPT, train_columns)
-converted_dataset_test = prepare_dataset(DATASET_PATH, SYSTEM_PROMPT, test_columns, 1)
+# images are decoded lazily in the data loader workers, labels come from the label store
+converted_dataset = prepare_dataset(
+    PHENOLOGY_DATASET_PATH, SYSTEM_PROMPT, train_columns
+)
+converted_dataset_test = prepare_dataset(
+    PHENOLOGY_DATASET_PATH, SYSTEM_PROMPT, test_columns, 1
+)
 
 print("Train len: ", len(converted_dataset))
 print("Test len: ", len(converted_dataset_test))
 
+if USE_VISION_CACHE:
+    converted_dataset = build_vision_cache(
+        converted_dataset, tokenizer, os.path.join(VISION_CACHE_DIR, "train")
+    )
+    converted_dataset_test = build_vision_cache(
+        converted_dataset_test, tokenizer, os.path.join(VISION_CACHE_DIR, "test")
+    )
+    data_collator = CachedVisionCollator(tokenizer)
+else:
+    data_collator = UnslothVisionDataCollator(model, tokenizer)
+
 
 # ---
 # train the model
@@ -95,7 +114,7 @@ FastVisionModel.for_training(model)  # Enable for training!
 trainer = SFTTrainer(
     model=model,
     tokenizer=tokenizer,
-    data_collator=UnslothVisionDataCollator(model, tokenizer),
+    data_collator=data_collator,
     train_dataset=converted_dataset,
     eval_dataset=converted_dataset_test,
     args=SFTConfig(
@@ -116,6 +135,7 @@ trainer = SFTTrainer(
         dataset_text_field="",
         dataset_kwargs={"skip_prepare_dataset": True},
         dataset_num_proc=4,
+        dataloader_num_workers=4,
         max_seq_length=2048,
     ),
 )
@@ -128,6 +148,7 @@ model.save_pretrained(f"finetuned_qwen_models/lora_model_{now}")  # Local saving
 tokenizer.save_pretrained(f"finetuned_qwen_models/lora_model_{now}")
 
 print(f"Saved model to finetuned_qwen_models/lora_model_{now}")
+model.cache_identity = f"finetuned_qwen_models/lora_model_{now}"
 
 
 # ---
@@ -135,7 +156,11 @@ print(f"Saved model to finetuned_qwen_models/lora_model_{now}")
 # ---
 
 print("\nTesting model:\n")
-df = pd.read_pickle(DATASET_PATH)
+df = load_columns(
+    DATASET_PATH,
+    [col + suffix for col in test_columns for suffix in ("_image", "_labels")],
+)
+cache = PredictionCache()  # predictions are reused when re-running the evaluation
 
 
 def print_errors(preds, gts, images):
@@ -163,7 +188,9 @@ for test_col in test_columns:
 
     for i in tqdm(range(len(images))):
         image_bytes = images[i]
-        lora_model_preds.append(inference(model, tokenizer, image_bytes, SYSTEM_PROMPT))
+        lora_model_preds.append(
+            inference(model, tokenizer, image_bytes, SYSTEM_PROMPT, cache=cache)
+        )
 
     lora_accuracy = round(np.mean(np.array(lora_model_preds) == ground_truth), 2)
     print(
@@ -187,7 +214,9 @@ for test_col in test_columns:
     base_model_preds = []
     for i in tqdm(range(len(images))):
         image_bytes = images[i]
-        pred = inference(base_model, base_tokenizer, image_bytes, SYSTEM_PROMPT)
+        pred = inference(
+            base_model, base_tokenizer, image_bytes, SYSTEM_PROMPT, cache=cache
+        )
         base_model_preds.append(pred)
 
     base_model_accuracy = round(np.mean(np.array(base_model_preds) == ground_truth), 2)
@@ -195,7 +224,7 @@ for test_col in test_columns:
 
 
 # we can also test easyocr to compare
-from easyocr_inference import inference_easyocr
+from easyocr_inference import inference_easyocr_batch
 
 for test_col in test_columns:
     print("Column: ", test_col)
@@ -204,11 +233,33 @@ for test_col in test_columns:
 
     ground_truth = df[test_col + "_labels"].values
 
-    easyocr_preds = []
-    for i in tqdm(range(len(images))):
-        image_bytes = images[i]
-        pred = inference_easyocr(image_bytes)
-        easyocr_preds.append(pred)
+    easyocr_preds = inference_easyocr_batch(images, cache=cache)
 
     easyocr_accuracy = round(np.mean(np.array(easyocr_preds) == ground_truth), 2)
     print(f"EasyOCR accuracy: {easyocr_accuracy}")
+
+
+# cascade: EasyOCR first, only uncertain cells go to the finetuned model
+from cascade import evaluate_cascade
+from constants import CASCADE_MIN_CONFIDENCE
+
+for test_col in test_columns:
+    print("Column: ", test_col)
+
+    images = df[test_col + "_image"].values
+
+    ground_truth = df[test_col + "_labels"].values
+
+    # EasyOCR and Qwen read the column once, the thresholds reuse their reads,
+    # and the cascade at CASCADE_MIN_CONFIDENCE is also timed for real
+    reports = evaluate_cascade(
+        model,
+        tokenizer,
+        images,
+        ground_truth,
+        SYSTEM_PROMPT,
+        min_confidence=[0.5, 0.7, 0.9, 0.95],
+        measured_confidence=CASCADE_MIN_CONFIDENCE,
+    )
+    for report in reports:
+        print(report)
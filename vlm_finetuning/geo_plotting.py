@@ -11,6 +11,8 @@ import matplotlib.pyplot as plt
 from branca.colormap import LinearColormap
 from typing import List, Dict, Tuple, Optional, Any, Union
 
+from columnar_store import load_columns
+
 
 class Config:
     """Configuration parameters for the geo plotting application."""
@@ -40,7 +42,7 @@ class DataLoader:
             - Positions
             - Predictions
         """
-        df_orig = pd.read_pickle(original_data_path)
+        df_orig = load_columns(original_data_path, ["location"], lazy=False)
         df = pd.read_parquet(ground_truth_path)
         df_preds = pd.read_parquet(predictions_path)
 
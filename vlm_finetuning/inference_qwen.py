@@ -2,15 +2,28 @@
 NOTE run inference with qwen model (base or finetuned)
 """
 
-import pandas as pd
+import numpy as np
 from tqdm import tqdm
-from qwen_helper_funcs import load_model, inference
-from constants import SYSTEM_PROMPT
+from qwen_helper_funcs import load_model, inference_batch
+from constants import (
+    SYSTEM_PROMPT,
+    BATCH_SIZE,
+    RUN_JOURNAL_DIR,
+    LOW_CONFIDENCE_LOGPROB,
+    PHENOLOGY_DATASET_PATH,
+)
+from blank_filter import find_blank_cells
+from prediction_cache import PredictionCache
+from run_journal import RunJournal
+from label_store import LabelStore
+from columnar_store import load_columns
 import os
 from helper_funcs import display_image
 
 
 LORA_MODEL_PATH = "./finetuned_qwen_models/lora_model_20250414_134955"
+USE_BLANK_FILTER = True  # skip cells the ink prefilter marks as blank
+CONSTRAINED_DECODING = True  # greedy decoding restricted to the cell grammar
 
 
 # ---
@@ -36,28 +49,74 @@ if __name__ == "__main__":
     # base_model, base_tokenizer = load_model() # base model
     model, tokenizer = load_model(LORA_MODEL_PATH)  # finetuned model
 
-    df = pd.read_pickle("data/phenology_df.pkl")
+    cache = PredictionCache()
+    label_store = LabelStore()
+    # restarting the script resumes from the journal of the same model
+    journal = RunJournal(
+        os.path.join(RUN_JOURNAL_DIR, os.path.basename(LORA_MODEL_PATH) + ".jsonl")
+    )
+    # image columns are read lazily, cell by cell
+    df = load_columns(
+        PHENOLOGY_DATASET_PATH,
+        ["number_image"] + [col + "_image" for col in cols_to_predict],
+    )
     display_image(df["number_image"].values[0])
 
     for col_to_predict in cols_to_predict:
 
-        predictions = []
-        for i in tqdm(range(len(df))):
-
-            image_bytes = df.iloc[i][col_to_predict + "_image"]
-            response = inference(model, tokenizer, image_bytes, SYSTEM_PROMPT)
-            predictions.append(response)
-            if i % 10 == 0:
-                display_image(image_bytes)
-                print("Prediction: ", response)
-
-        # write predictions to file
-        labels_path = f"labels/label_{col_to_predict}.txt"
-        if os.path.exists(labels_path):
-            print("PATH ALREADY EXISTS; SKIPPING WRITING")
-        else:
-            with open(labels_path, "w") as f:
-                for pred in predictions:
-                    f.write(pred + "\n")
-
-            print(f"Predictions written to {labels_path}")
+        images = df[col_to_predict + "_image"].values
+        done_rows = journal.done_rows(col_to_predict)
+        if len(done_rows) < len(images):
+            if USE_BLANK_FILTER:
+                is_blank = find_blank_cells(images)
+            else:
+                is_blank = np.zeros(len(images), dtype=bool)
+            print(f"{col_to_predict}: skipping {is_blank.sum()} of {len(images)} blank cells")
+
+            blank_rows = [i for i in np.flatnonzero(is_blank) if i not in done_rows]
+            # blank filtered cells get no logprob, the model never saw them
+            journal.record_many(col_to_predict, blank_rows, [""] * len(blank_rows))
+
+            rows_to_predict = [i for i in np.flatnonzero(~is_blank) if i not in done_rows]
+            for start in tqdm(range(0, len(rows_to_predict), BATCH_SIZE)):
+                rows = rows_to_predict[start : start + BATCH_SIZE]
+                responses, scores = inference_batch(
+                    model,
+                    tokenizer,
+                    images[rows],
+                    SYSTEM_PROMPT,
+                    cache=cache,
+                    constrained=CONSTRAINED_DECODING,
+                    return_scores=True,
+                )
+                journal.record_many(
+                    col_to_predict,
+                    rows,
+                    responses,
+                    logprob=[score["logprob"] for score in scores],
+                    token_logprobs=[score["token_logprobs"] for score in scores],
+                )
+
+        # review the uncertain tail instead of the whole column
+        predictions = journal.column_values(col_to_predict, len(images))
+        low_confidence_rows = journal.least_confident_rows(
+            col_to_predict, max_logprob=LOW_CONFIDENCE_LOGPROB
+        )
+        print(f"{col_to_predict}: {len(low_confidence_rows)} low confidence predictions")
+        for i in low_confidence_rows:
+            display_image(images[i])
+            print(f"Row {i} prediction: ", predictions[i])
+
+        # human labels in the store are kept, the journal still has every prediction
+        logprobs = journal.column_values(col_to_predict, len(images), "logprob")
+        changed = label_store.put_many(
+            col_to_predict,
+            range(len(images)),
+            predictions,
+            os.path.basename(LORA_MODEL_PATH),
+            [None if logprob is None else np.exp(logprob) for logprob in logprobs],
+        )
+        print(f"{changed} predictions written to {label_store.path}")
+
+    journal.close()
+    label_store.close()
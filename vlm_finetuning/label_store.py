@@ -0,0 +1,263 @@
+"""
+SQLite label database keyed by (table_id, field)
+
+labels/label_<field>.txt files hold one label per line, and the line number is
+the only link to the table. Here every label is a row keyed by table_id (the
+row of the table in phenology_df.pkl) and field, with the source that wrote it
+(HUMAN_SOURCE for manual labels, otherwise e.g. the model name), a confidence
+and the time it was written. A correction is a single row update, and every
+write is kept in label_history.
+
+Model writes do not replace human labels unless asked to, the same rule the
+label files followed. Labels are indexed by field and label, so pattern
+queries (find) and the export to one column per field (to_wide) stay fast.
+
+Run this file to import the existing label files, or to write them back for
+tools that still read them:
+
+    python label_store.py import labels
+    python label_store.py export labels
+"""
+
+import argparse
+import math
+import os
+import sqlite3
+import time
+
+import pandas as pd
+
+from constants import LABEL_STORE_PATH
+
+HUMAN_SOURCE = "human"
+
+
+class LabelStore:
+    """Current label and history of every (table_id, field)"""
+
+    def __init__(self, path=LABEL_STORE_PATH):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS labels (
+                table_id INTEGER NOT NULL,
+                field TEXT NOT NULL,
+                label TEXT NOT NULL,
+                source TEXT NOT NULL,
+                confidence REAL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (table_id, field)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS labels_by_field ON labels (field, label);
+            CREATE INDEX IF NOT EXISTS labels_by_label ON labels (label);
+
+            CREATE TABLE IF NOT EXISTS label_history (
+                table_id INTEGER NOT NULL,
+                field TEXT NOT NULL,
+                label TEXT NOT NULL,
+                source TEXT NOT NULL,
+                confidence REAL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS history_by_cell ON label_history (table_id, field);
+
+            -- every version that reaches the labels table is kept
+            CREATE TRIGGER IF NOT EXISTS labels_insert_history AFTER INSERT ON labels
+            BEGIN
+                INSERT INTO label_history VALUES (NEW.table_id, NEW.field, NEW.label,
+                    NEW.source, NEW.confidence, NEW.updated_at);
+            END;
+            CREATE TRIGGER IF NOT EXISTS labels_update_history AFTER UPDATE ON labels
+            BEGIN
+                INSERT INTO label_history VALUES (NEW.table_id, NEW.field, NEW.label,
+                    NEW.source, NEW.confidence, NEW.updated_at);
+            END;
+            """)
+        self.connection.commit()
+
+    def put(self, table_id, field, label, source, confidence=None, overwrite=False):
+        return self.put_many(
+            field, [table_id], [label], source, [confidence], overwrite
+        )
+
+    def put_many(
+        self, field, table_ids, labels, source, confidences=None, overwrite=False
+    ):
+        """
+        Write labels of one field, returns the number of rows that changed.
+
+        Rows written by HUMAN_SOURCE are only replaced by another source with
+        overwrite=True. Writing the same label, source and confidence again
+        changes nothing and adds no history.
+        """
+        if confidences is None:
+            confidences = [None] * len(labels)
+        now = time.time()
+        cursor = self.connection.executemany(
+            """
+            INSERT INTO labels (table_id, field, label, source, confidence, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (table_id, field) DO UPDATE SET
+                label = excluded.label,
+                source = excluded.source,
+                confidence = excluded.confidence,
+                updated_at = excluded.updated_at
+            WHERE (? OR labels.source != ? OR excluded.source = ?)
+                AND (labels.label IS NOT excluded.label
+                     OR labels.source IS NOT excluded.source
+                     OR labels.confidence IS NOT excluded.confidence)
+            """,
+            [
+                (
+                    int(table_id),
+                    field,
+                    "" if label is None else str(label),
+                    source,
+                    confidence,
+                    now,
+                    overwrite,
+                    HUMAN_SOURCE,
+                    HUMAN_SOURCE,
+                )
+                for table_id, label, confidence in zip(table_ids, labels, confidences)
+            ],
+        )
+        self.connection.commit()
+        return cursor.rowcount
+
+    def get(self, table_id, field):
+        """Current label of a cell, or None"""
+        row = self.connection.execute(
+            "SELECT label FROM labels WHERE table_id = ? AND field = ?",
+            (int(table_id), field),
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def history(self, table_id, field):
+        """Every version of a cell, oldest first"""
+        return pd.read_sql_query(
+            "SELECT * FROM label_history WHERE table_id = ? AND field = ? "
+            "ORDER BY updated_at",
+            self.connection,
+            params=(int(table_id), field),
+        )
+
+    @property
+    def fields(self):
+        rows = self.connection.execute(
+            "SELECT DISTINCT field FROM labels ORDER BY field"
+        )
+        return [field for (field,) in rows]
+
+    def find(self, pattern, fields=None, source=None):
+        """
+        Current labels matching a GLOB pattern, e.g. "(*" or "1?".
+
+        GLOB is case sensitive and uses the label index for patterns with a
+        fixed prefix. [ and ] are GLOB syntax, match them as "[[]" and "[]]".
+        """
+        query = "SELECT * FROM labels WHERE label GLOB ?"
+        params = [pattern]
+        if fields is not None:
+            query += f" AND field IN ({','.join('?' * len(fields))})"
+            params += list(fields)
+        if source is not None:
+            query += " AND source = ?"
+            params.append(source)
+        return pd.read_sql_query(
+            query + " ORDER BY field, table_id", self.connection, params=params
+        )
+
+    def to_wide(self, fields=None, num_tables=None, suffix=""):
+        """
+        Labels with one row per table_id and one column per field (+ suffix).
+
+        num_tables defaults to the largest table_id + 1. Cells without a label
+        are "", as in the label files.
+        """
+        fields = self.fields if fields is None else list(fields)
+        long = pd.read_sql_query(
+            f"SELECT table_id, field, label FROM labels "
+            f"WHERE field IN ({','.join('?' * len(fields))})",
+            self.connection,
+            params=fields,
+        )
+        if num_tables is None:
+            num_tables = int(long["table_id"].max()) + 1 if len(long) else 0
+        wide = long.pivot(index="table_id", columns="field", values="label")
+        wide = wide.reindex(index=range(num_tables), columns=fields).fillna("")
+        wide.columns = [field + suffix for field in fields]
+        wide.index.name = "table_id"
+        return wide
+
+    def column(self, field, num_tables=None):
+        """Labels of a field in table order, like the lines of its label file"""
+        return self.to_wide([field], num_tables)[field].tolist()
+
+    def import_label_files(self, labels_dir="labels", source=HUMAN_SOURCE):
+        """
+        Import every label_<field>.txt, line i is table_id i.
+
+        logprob_<field>.txt next to it becomes the confidence (exp(logprob)).
+        Returns the number of rows that changed per field.
+        """
+        changed = {}
+        for file_name in sorted(os.listdir(labels_dir)):
+            if not (file_name.startswith("label_") and file_name.endswith(".txt")):
+                continue
+            field = file_name[len("label_") : -len(".txt")]
+            labels = _read_lines(os.path.join(labels_dir, file_name))
+            confidences = None
+            logprob_path = os.path.join(labels_dir, f"logprob_{field}.txt")
+            if os.path.exists(logprob_path):
+                confidences = [
+                    math.exp(float(value)) if value else None
+                    for value in _read_lines(logprob_path)
+                ]
+            changed[field] = self.put_many(
+                field, range(len(labels)), labels, source, confidences
+            )
+        return changed
+
+    def export_label_files(self, labels_dir="labels", fields=None, num_tables=None):
+        """Write label_<field>.txt files, one line per table_id"""
+        from run_journal import write_lines_atomically
+
+        wide = self.to_wide(fields, num_tables)
+        for field in wide.columns:
+            write_lines_atomically(
+                os.path.join(labels_dir, f"label_{field}.txt"), wide[field].tolist()
+            )
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM labels").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+def _read_lines(path):
+    with open(path, "r") as f:
+        return [row.replace("\n", "") for row in f.readlines()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("labels_dir", nargs="?", default="labels")
+    parser.add_argument("--store", default=LABEL_STORE_PATH)
+    parser.add_argument(
+        "--source", default=HUMAN_SOURCE, help="source of imported labels"
+    )
+    args = parser.parse_args()
+
+    store = LabelStore(args.store)
+    if args.command == "import":
+        changed = store.import_label_files(args.labels_dir, args.source)
+        print(f"{sum(changed.values())} labels of {len(changed)} fields imported")
+    else:
+        store.export_label_files(args.labels_dir)
+        print(f"{len(store.fields)} label files written to {args.labels_dir}")
+    store.close()
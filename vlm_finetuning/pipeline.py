@@ -0,0 +1,156 @@
+"""
+Overlap input preparation with model compute
+
+Decoding the cell images, applying the chat template, tokenization and image
+preprocessing run in a thread pool, a bounded number of batches ahead of the
+model, so the model does not wait for the CPU between batches. Per-stage
+timings show whether a run is preprocessing-bound or model-bound.
+
+run_pipeline is generic, for generate_description the preparation step is
+prepare_description_inputs from image_processing/notebooks/models/model_utils.py
+"""
+
+import copy
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import torch
+
+from constants import BATCH_SIZE, PIPELINE_WORKERS, PIPELINE_PREFETCH
+from prepare_data_qwen import prep_image
+
+
+class StageTimer:
+    """Seconds spent per pipeline stage, summed over all threads"""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.seconds[stage] += time.perf_counter() - start
+
+    def report(self):
+        """Stage timings plus wall time, and which side the run is waiting on"""
+        report = dict(self.seconds)
+        report["wall"] = time.perf_counter() - self._start
+        # the model thread waiting for inputs means preparation can not keep up
+        waiting = report.get("wait_for_inputs", 0.0) / report["wall"]
+        report["bound_by"] = "preprocessing" if waiting > 0.1 else "model"
+        return report
+
+
+def run_pipeline(
+    batches,
+    prepare,
+    compute,
+    num_workers=PIPELINE_WORKERS,
+    max_prefetch=PIPELINE_PREFETCH,
+    timer=None,
+):
+    """
+    Run prepare(batch) in worker threads and compute(prepared) in this thread.
+
+    At most max_prefetch prepared batches are in flight, which caps memory.
+    Returns the results of compute in the order of batches.
+    """
+    timer = timer or StageTimer()
+    batches = iter(batches)
+    pending = deque()
+    results = []
+    with ThreadPoolExecutor(num_workers) as executor:
+
+        def submit_next():
+            batch = next(batches, None)
+            if batch is not None:
+                pending.append(executor.submit(prepare, batch))
+
+        for _ in range(max_prefetch):
+            submit_next()
+        while pending:
+            with timer.time("wait_for_inputs"):
+                prepared = pending.popleft().result()
+            submit_next()
+            results.append(compute(prepared))
+    return results
+
+
+def pipelined_inference(
+    model,
+    tokenizer,
+    list_of_image_bytes,
+    system_prompt,
+    batch_size=BATCH_SIZE,
+    num_workers=PIPELINE_WORKERS,
+    max_prefetch=PIPELINE_PREFETCH,
+    constrained=False,
+    prefix_cache=None,
+    return_scores=False,
+    timer=None,
+):
+    """
+    Same predictions as qwen_helper_funcs.inference_batch, with input
+    preparation running ahead of the model in num_workers threads.
+    return_scores works as in inference_batch.
+
+    Pass a StageTimer to get per-stage timings with timer.report().
+    """
+    from qwen_helper_funcs import prompt_text, batch_inputs, generate_predictions
+
+    timer = timer or StageTimer()
+    input_text = prompt_text(tokenizer, system_prompt, prefix_cache)
+    pin_memory = model.device.type == "cuda"
+
+    # fast tokenizers can not be used from several threads at once, each
+    # worker thread gets its own left padding copy of the processor
+    thread_state = threading.local()
+
+    def thread_tokenizer():
+        if not hasattr(thread_state, "tokenizer"):
+            thread_state.tokenizer = copy.deepcopy(tokenizer)
+            getattr(
+                thread_state.tokenizer, "tokenizer", thread_state.tokenizer
+            ).padding_side = "left"
+        return thread_state.tokenizer
+
+    def prepare(batch):
+        with timer.time("decode_images"):
+            images = [prep_image(image_bytes) for image_bytes in batch]
+        with timer.time("preprocess"):
+            inputs = batch_inputs(thread_tokenizer(), images, input_text)
+        if pin_memory:
+            with timer.time("pin_memory"):
+                for name, value in inputs.items():
+                    if isinstance(value, torch.Tensor):
+                        inputs[name] = value.pin_memory()
+        return inputs
+
+    def compute(inputs):
+        with timer.time("transfer"):
+            inputs = inputs.to(model.device, non_blocking=pin_memory)
+        with timer.time("generate"):
+            result = generate_predictions(
+                model, tokenizer, inputs, constrained, prefix_cache, return_scores
+            )
+        return result
+
+    batches = (
+        list_of_image_bytes[start : start + batch_size]
+        for start in range(0, len(list_of_image_bytes), batch_size)
+    )
+    results = run_pipeline(batches, prepare, compute, num_workers, max_prefetch, timer)
+    if return_scores:
+        predictions = [prediction for result in results for prediction in result[0]]
+        scores = [score for result in results for score in result[1]]
+        return predictions, scores
+    return [prediction for predictions in results for prediction in predictions]
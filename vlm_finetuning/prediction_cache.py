@@ -0,0 +1,90 @@
+"""
+Persistent on-disk cache of OCR predictions
+
+Predictions are keyed by the hash of the image bytes together with the model
+identity, the prompt and the decoding parameters, so re-running an evaluation
+only calls the model for combinations it has not seen before.
+"""
+
+import hashlib
+import json
+import sqlite3
+import time
+
+from constants import PREDICTION_CACHE_PATH
+
+
+def model_identity(model):
+    """
+    Name used to tell models apart in the cache.
+
+    load_model() stores the model or adapter path on the model as cache_identity,
+    otherwise fall back to the name the weights were loaded from.
+    """
+    identity = getattr(model, "cache_identity", None)
+    if identity is None:
+        identity = getattr(model, "name_or_path", None) or model.config._name_or_path
+    return identity
+
+
+class PredictionCache:
+    """SQLite backed mapping from (image, model, prompt, decoding params) to a prediction"""
+
+    def __init__(self, path=PREDICTION_CACHE_PATH):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS predictions "
+            "(key TEXT PRIMARY KEY, prediction TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def make_key(image_bytes, model_id, prompt, params):
+        """Hash everything that can change the prediction into one key"""
+        key = hashlib.sha256()
+        key.update(hashlib.sha256(image_bytes).digest())
+        key.update(model_id.encode())
+        key.update(hashlib.sha256(prompt.encode()).digest())
+        key.update(json.dumps(params, sort_keys=True).encode())
+        return key.hexdigest()
+
+    def get(self, key):
+        row = self.connection.execute(
+            "SELECT prediction FROM predictions WHERE key = ?", (key,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def get_many(self, keys):
+        """Look up many keys at once, returns a dict with the keys that were found"""
+        found = {}
+        keys = list(keys)
+        # stay below SQLite's limit on the number of query parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT key, prediction FROM predictions WHERE key IN ({placeholders})",
+                chunk,
+            )
+            found.update(rows)
+        return found
+
+    def put(self, key, prediction):
+        self.put_many([(key, prediction)])
+
+    def put_many(self, items):
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO predictions (key, prediction, created_at) VALUES (?, ?, ?)",
+            [(key, prediction, now) for key, prediction in items],
+        )
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
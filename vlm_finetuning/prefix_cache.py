@@ -0,0 +1,181 @@
+"""
+Reuse the KV cache of the prompt prefix that every cell request shares
+
+Everything before the first image in the prompt (chat template header and the
+system prompt) is the same for every cell. PrefixCache runs the model on that
+prefix once and starts every request from a copy of its KV cache, so prefill
+only has to process the image and the tokens after it.
+
+model.generate cannot resume from a cache while also encoding an image for
+Qwen2.5-VL (it drops pixel_values and recomputes the multimodal RoPE positions
+once a cache is present), so PrefixCache runs its own greedy decoding loop.
+"""
+
+import copy
+
+import torch
+
+
+def _rope_index_fn(model):
+    # get_rope_index moved from the generation class to the inner model in newer transformers
+    if hasattr(model, "get_rope_index"):
+        return model.get_rope_index
+    return model.model.get_rope_index
+
+
+class PrefixCache:
+    """KV cache of the prompt prefix shared by every cell request to a model"""
+
+    def __init__(self, model):
+        self.model = model
+        self.prefix_ids = None
+        self.past_key_values = None
+
+    def _prefix_length(self, input_ids):
+        vision_start = input_ids[0] == self.model.config.vision_start_token_id
+        if not vision_start.any():
+            return input_ids.shape[1]
+        return int(vision_start.nonzero()[0, 0])
+
+    @torch.no_grad()
+    def _cache_for(self, input_ids):
+        """Copy of the prefix KV cache for a batch, recomputed if the prefix changed"""
+        prefix_length = self._prefix_length(input_ids)
+        prefix_ids = input_ids[:1, :prefix_length]
+        if self.prefix_ids is None or not torch.equal(self.prefix_ids, prefix_ids):
+            outputs = self.model(input_ids=prefix_ids, use_cache=True)
+            self.prefix_ids = prefix_ids
+            self.past_key_values = outputs.past_key_values
+
+        past_key_values = copy.deepcopy(self.past_key_values)
+        if input_ids.shape[0] > 1:
+            past_key_values.batch_repeat_interleave(input_ids.shape[0])
+        return past_key_values, prefix_length
+
+    def can_use(self, inputs):
+        """The cached prefix only lines up with unpadded rows that all share it"""
+        input_ids = inputs["input_ids"]
+        prefix_length = self._prefix_length(input_ids)
+        return bool(inputs["attention_mask"].all()) and bool(
+            (input_ids[:, :prefix_length] == input_ids[:1, :prefix_length]).all()
+        )
+
+    @torch.no_grad()
+    def prefill(self, inputs):
+        """
+        Run the model on everything after the cached prefix.
+
+        Returns the logits of the last position, the KV cache and the RoPE
+        deltas needed to continue decoding.
+        """
+        input_ids = inputs["input_ids"]
+        past_key_values, prefix_length = self._cache_for(input_ids)
+
+        position_ids, rope_deltas = _rope_index_fn(self.model)(
+            input_ids,
+            inputs.get("image_grid_thw"),
+            None,
+            attention_mask=inputs["attention_mask"],
+        )
+        outputs = self.model(
+            input_ids=input_ids[:, prefix_length:],
+            attention_mask=inputs["attention_mask"],
+            position_ids=position_ids[:, :, prefix_length:],
+            pixel_values=inputs.get("pixel_values"),
+            image_grid_thw=inputs.get("image_grid_thw"),
+            past_key_values=past_key_values,
+            cache_position=torch.arange(
+                prefix_length, input_ids.shape[1], device=input_ids.device
+            ),
+            use_cache=True,
+        )
+        return outputs.logits[:, -1, :], outputs.past_key_values, rope_deltas
+
+    @torch.no_grad()
+    def generate(
+        self,
+        inputs,
+        max_new_tokens,
+        logits_processor=None,
+        eos_token_ids=None,
+        output_logits=False,
+    ):
+        """
+        Greedy decoding starting from the cached prefix.
+
+        Returns the prompt followed by the generated tokens like model.generate,
+        finished rows are filled up with the pad token. Inputs the prefix can
+        not be used for (padded batches) are passed to model.generate instead.
+        With output_logits=True the raw logits of every step (before the logits
+        processor) are returned as well, as a tuple like model.generate does.
+        """
+        generation_config = self.model.generation_config
+        if eos_token_ids is None:
+            eos_token_ids = generation_config.eos_token_id
+            if not isinstance(eos_token_ids, (list, tuple, set)):
+                eos_token_ids = [eos_token_ids]
+        eos_token_ids = torch.tensor(
+            sorted(eos_token_ids), device=inputs["input_ids"].device
+        )
+        pad_token_id = generation_config.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = int(eos_token_ids[0])
+
+        if not self.can_use(inputs):
+            response = self.model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                temperature=None,
+                logits_processor=logits_processor,
+                eos_token_id=eos_token_ids.tolist(),
+                pad_token_id=pad_token_id,
+                output_logits=output_logits,
+                return_dict_in_generate=output_logits,
+            )
+            if output_logits:
+                return response.sequences, response.logits
+            return response
+
+        logits, past_key_values, rope_deltas = self.prefill(inputs)
+
+        sequences = inputs["input_ids"]
+        attention_mask = inputs["attention_mask"]
+        finished = torch.zeros(
+            sequences.shape[0], dtype=torch.bool, device=sequences.device
+        )
+        step_logits = []
+        for step in range(max_new_tokens):
+            if output_logits:
+                step_logits.append(logits)
+            scores = logits.float()
+            if logits_processor is not None:
+                scores = logits_processor(sequences, scores)
+            next_tokens = scores.argmax(dim=-1)
+            next_tokens = torch.where(finished, pad_token_id, next_tokens)
+            sequences = torch.cat([sequences, next_tokens[:, None]], dim=-1)
+            finished |= torch.isin(next_tokens, eos_token_ids)
+            if finished.all() or step == max_new_tokens - 1:
+                break
+
+            attention_mask = torch.cat(
+                [attention_mask, attention_mask.new_ones((attention_mask.shape[0], 1))],
+                dim=-1,
+            )
+            # text tokens after the image continue from the last multimodal position
+            position = sequences.shape[1] - 1
+            position_ids = (position + rope_deltas).view(1, -1, 1).expand(3, -1, 1)
+            outputs = self.model(
+                input_ids=next_tokens[:, None],
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                cache_position=torch.tensor([position], device=sequences.device),
+                use_cache=True,
+            )
+            logits = outputs.logits[:, -1, :]
+            past_key_values = outputs.past_key_values
+
+        if output_logits:
+            return sequences, tuple(step_logits)
+        return sequences
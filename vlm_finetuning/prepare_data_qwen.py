@@ -1,50 +1,35 @@
-import pandas as pd
-from PIL import Image as PILImage
-from io import BytesIO
-import random
-from datasets import Dataset
+import numpy as np
 
-RANDOM_STATE = 42
+from cell_codec import to_pil
+from columnar_store import load_columns
+from constants import PHENOLOGY_DATASET_PATH
+from label_store import LabelStore
 
-random.seed(RANDOM_STATE)
+RANDOM_STATE = 42
 
 
 def make_labelled_df(
-    dataset_path="data/phenology_df.pkl", labeled_columns=["blueberry_flowering"]
+    dataset_path=PHENOLOGY_DATASET_PATH, labeled_columns=["blueberry_flowering"]
 ):
     assert len(set(labeled_columns)) == len(
         labeled_columns
     ), "labeled_columns must be unique"
-    df = pd.read_pickle(dataset_path)
-
-    df_labelled = df.copy()
-
-    for col in labeled_columns:
-        print(col)
-        with open(f"labels/label_{col}.txt", "r") as f:
-            label_col = f.readlines()
-        label_col = [row.replace("\n", "") for row in label_col]
-
-        df[col + "_labels"] = label_col
-
-    with open("labels/label_location.txt", "r") as f:
-        label_location = f.readlines()
-    label_location = [row.replace("\n", "") for row in label_location]
-    with open("labels/label_position_new.txt", "r") as f:
-        label_position = f.readlines()
-    label_position = [row.replace("\n", "") for row in label_position]
-    df_labelled["location_labels"] = label_location
-    df_labelled["position_labels"] = (
-        label_position  # NOTE not using these for training, different labels basically
+    # only the image columns of the labelled fields are read
+    df_labelled = load_columns(
+        dataset_path, [col + "_image" for col in labeled_columns], lazy=False
     )
 
+    label_store = LabelStore()
+    labels = label_store.to_wide(labeled_columns, len(df_labelled), suffix="_labels")
+    label_store.close()
+    for col in labels.columns:
+        df_labelled[col] = labels[col].values
+
     all_columns = [col + "_labels" for col in labeled_columns] + [
         col + "_image" for col in labeled_columns
     ]
 
-    df_labelled = df[all_columns]
-
-    df_labelled.to_pickle("data/df_labelled_all.pkl")
+    df_labelled[all_columns].to_pickle("data/df_labelled_all.pkl")
 
 
 def _convert_to_conversation(sample, system_prompt):
@@ -62,86 +47,96 @@ def _convert_to_conversation(sample, system_prompt):
 
 
 def prep_image(image_bytes):
-    return PILImage.open(BytesIO(image_bytes))
+    return to_pil(image_bytes)
 
 
-def prepare_inference_sample(instruction):
+def prepare_inference_sample(instruction, image_first=True):
+    """
+    image_first=False puts the instruction before the image like in training,
+    which makes the instruction part of the prompt prefix shared by all cells
+    """
+    content = [{"type": "image"}, {"type": "text", "text": instruction}]
+    if not image_first:
+        content.reverse()
     return [
         {
             "role": "user",
-            "content": [{"type": "image"}, {"type": "text", "text": instruction}],
+            "content": content,
         }
     ]
 
 
-def prepare_dataset(
-    dataset_path, system_prompt, labeled_columns, accepted_blank_percentage=0.3
-):
-    """percentage blank accepted is % of labels you accept to be empty string"""
-
-    image_and_label_columns = [
-        (col + "_image", col + "_labels") for col in labeled_columns
-    ]
-
-    df_labelled = pd.read_pickle(dataset_path)
-    # now prepare data for qwen
+class CellConversations:
+    """
+    Fine-tuning conversations, the cell image is decoded when a sample is accessed.
 
-    # Prepare the data in the format expected by Dataset
-    dataset_dict = {
-        "image": [],
-        "text": [],
-        "category": [],  # To keep track of which category (flowering or fruit)
-    }
+    Only the column, row and label of every sample are kept in memory, the
+    images stay in the dataset (read lazily from a columnar store). The
+    dataset can be pickled, so the data loader workers do the decoding.
+    """
 
-    # make a 2d list of all images and labels
-    all_images = []
-    all_labels = []
-    for img_col, label_col in image_and_label_columns:
-        all_images.extend(df_labelled[img_col].tolist())
-        all_labels.extend(df_labelled[label_col].tolist())
+    def __init__(self, images, columns, rows, labels, system_prompt):
+        self.images = images  # image column name -> image bytes per row
+        self.image_columns = list(images)
+        self.columns = columns  # index into image_columns of every sample
+        self.rows = rows
+        self.labels = labels
+        self.system_prompt = system_prompt
 
-    tot_num_labels = len(all_labels)
-    num_blank_labels = sum(1 for label in all_labels if label == "")
+    def __len__(self):
+        return len(self.labels)
 
-    accepted_num_blank_labels = int(accepted_blank_percentage * tot_num_labels)
+    def __getitem__(self, i):
+        images = self.images[self.image_columns[self.columns[i]]]
+        sample = {
+            "image": prep_image(images[int(self.rows[i])]),
+            "text": self.labels[i],
+        }
+        return _convert_to_conversation(sample, self.system_prompt)
 
-    # select blank images to ignore (since we don't want too many blank labels)
-    blank_labeled_images_indices = [
-        i for i, label in enumerate(all_labels) if label == "" or label == "%"
-    ]
-    num_indices_to_ignore = (
-        len(blank_labeled_images_indices) - accepted_num_blank_labels
-    )
-    if num_indices_to_ignore > 0:
-        indices_to_ignore = random.sample(
-            blank_labeled_images_indices, num_indices_to_ignore
-        )
-    else:
-        indices_to_ignore = []
-
-    all_images = [img for i, img in enumerate(all_images) if i not in indices_to_ignore]
-    all_labels = [
-        label for i, label in enumerate(all_labels) if i not in indices_to_ignore
-    ]
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
 
-    # set empty labels to unknown
-    all_labels = ["unknown" if label == "" else label for label in all_labels]
 
-    # Extract image-label pairs from the DataFrame
-    for img, label in zip(all_images, all_labels):
-        # Convert bytes to PIL Image
-        pil_image = prep_image(img)
+def _load_labels(dataset, labeled_columns):
+    # df_labelled_all.pkl has the labels, otherwise they come from the label store
+    if all(col + "_labels" in dataset for col in labeled_columns):
+        return [np.asarray(dataset[col + "_labels"]) for col in labeled_columns]
+    label_store = LabelStore()
+    labels = label_store.to_wide(labeled_columns, len(dataset))
+    label_store.close()
+    return [labels[col].to_numpy() for col in labeled_columns]
 
-        # Add to dataset dictionary
-        dataset_dict["image"].append(pil_image)
-        dataset_dict["text"].append(label)
-        dataset_dict["category"].append(img_col.replace("_image", ""))
 
-    # Create the Dataset
-    dataset = Dataset.from_dict(dataset_dict)
+def prepare_dataset(
+    dataset_path, system_prompt, labeled_columns, accepted_blank_percentage=0.3
+):
+    """
+    percentage blank accepted is % of labels you accept to be empty string
+
+    Returns a CellConversations dataset. Blank ("" or "%") labels above that
+    percentage are dropped at random, empty labels become "unknown".
+    """
+    dataset = load_columns(dataset_path)
+    images = {col: dataset[col + "_image"].values for col in labeled_columns}
+    labels_per_column = _load_labels(dataset, labeled_columns)
+    del dataset
+
+    # one entry per (column, row) sample
+    num_rows = [len(labels) for labels in labels_per_column]
+    columns = np.repeat(np.arange(len(labeled_columns)), num_rows)
+    rows = np.concatenate([np.arange(n) for n in num_rows])
+    labels = np.concatenate(labels_per_column).astype(object)
+
+    # drop blank samples at random, since we don't want too many blank labels
+    is_blank = (labels == "") | (labels == "%")
+    num_to_ignore = is_blank.sum() - int(accepted_blank_percentage * len(labels))
+    keep = np.ones(len(labels), dtype=bool)
+    if num_to_ignore > 0:
+        rng = np.random.default_rng(RANDOM_STATE)
+        keep[rng.choice(np.flatnonzero(is_blank), num_to_ignore, replace=False)] = False
 
-    converted_dataset = [
-        _convert_to_conversation(sample, system_prompt) for sample in dataset
-    ]
+    # set empty labels to unknown
+    labels = np.where(labels[keep] == "", "unknown", labels[keep])
 
-    return converted_dataset
+    return CellConversations(images, columns[keep], rows[keep], labels, system_prompt)
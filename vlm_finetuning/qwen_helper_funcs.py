@@ -1,61 +1,419 @@
+import json
+
 from prepare_data_qwen import prep_image, prepare_inference_sample
-from unsloth import FastVisionModel
 from tqdm import tqdm
+import torch
+from transformers import LogitsProcessorList
 
-from constants import TEMPERATURE, MIN_P, MAX_NEW_TOKENS
+from constants import (
+    BASE_MODEL_ID,
+    TEMPERATURE,
+    MIN_P,
+    MAX_NEW_TOKENS,
+    GRAMMAR_MAX_NEW_TOKENS,
+    BATCH_SIZE,
+    CPU_QUANTIZE,
+    CPU_THREADS,
+    CPU_INTEROP_THREADS,
+)
+from prediction_cache import model_identity
+from cell_grammar import CellGrammarLogitsProcessor, eos_token_ids
+from backend import select_device, configure_cpu_threads, quantize_int8
 
 
-def load_model(LORA_MODEL_PATH=None):
-    model_path = (
-        "unsloth/Qwen2.5-VL-7B-Instruct" if LORA_MODEL_PATH is None else LORA_MODEL_PATH
-    )
+def load_model(LORA_MODEL_PATH=None, device=None, quantize=CPU_QUANTIZE, num_workers=1):
+    """
+    Load the base model, or the base model with a LoRA adapter.
+
+    On cuda the model is loaded with unsloth, onto the GPU of device if it
+    has an index (e.g. "cuda:1"). Unsloth needs a GPU, so on other
+    devices the model is loaded with transformers and the adapter is merged
+    into the weights. On CPU the linear layers are quantized to int8 unless
+    quantize=False, and the physical cores are split between num_workers
+    worker processes.
+    """
+    model_path = BASE_MODEL_ID if LORA_MODEL_PATH is None else LORA_MODEL_PATH
+    device = select_device(device)
+
+    print("Loading model from: ", model_path, "on", device)
+    if device.type == "cuda":
+        from unsloth import FastVisionModel
+
+        # a worker given "cuda:i" loads its copy of the model onto GPU i only
+        device_map = "sequential"
+        if device.index is not None:
+            torch.cuda.set_device(device)
+            device_map = {"": device.index}
+        model, tokenizer = FastVisionModel.from_pretrained(
+            model_path,
+            load_in_4bit=False,
+            use_gradient_checkpointing="unsloth",
+            device_map=device_map,
+        )
+
+        FastVisionModel.for_inference(model)
+    else:
+        model, tokenizer = _load_model_transformers(LORA_MODEL_PATH, device, quantize)
+        if device.type == "cpu":
+            threads = configure_cpu_threads(
+                CPU_THREADS, CPU_INTEROP_THREADS, num_workers
+            )
+            print(f"Using {threads} CPU threads, int8 quantization: {quantize}")
+    model.cache_identity = model_path
+    if device.type == "cpu" and quantize:
+        model.cache_identity += ":int8"  # quantized predictions can differ
+
+    return model, tokenizer
 
-    print("Loading model from: ", model_path)
-    model, tokenizer = FastVisionModel.from_pretrained(
-        model_path,
-        load_in_4bit=False,
-        use_gradient_checkpointing="unsloth",
+
+def _load_model_transformers(LORA_MODEL_PATH, device, quantize):
+    from transformers import AutoProcessor, Qwen2_5_VLForConditionalGeneration
+
+    # dynamic int8 quantization needs float32 weights
+    dtype = torch.float32 if device.type == "cpu" else torch.bfloat16
+    model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
+        BASE_MODEL_ID, torch_dtype=dtype
     )
+    if LORA_MODEL_PATH is not None:
+        from peft import PeftModel
 
-    FastVisionModel.for_inference(model)
+        model = PeftModel.from_pretrained(model, LORA_MODEL_PATH).merge_and_unload()
+    model = model.to(device).eval()
+    if device.type == "cpu" and quantize:
+        model = quantize_int8(model)
 
+    tokenizer = AutoProcessor.from_pretrained(
+        BASE_MODEL_ID if LORA_MODEL_PATH is None else LORA_MODEL_PATH
+    )
     return model, tokenizer
 
 
-def inference(model, tokenizer, image_bytes, system_prompt):
+def _clean_response(response_text):
+    response_text = response_text.strip()
+    if response_text == "unknown":
+        response_text = ""
+    response_text = response_text.replace("\n", "")  # Remove newlines
+    return response_text
+
+
+def _sequence_scores(step_logits, generated, eos_ids):
+    """
+    Log-probabilities of the generated tokens under the model.
+
+    Uses the raw logits, before temperature, min_p or the grammar, and stops at
+    the first eos token (included, it is the model saying the answer is done).
+    Returns one dict per row with the per-token and the summed sequence logprob.
+    """
+    token_logprobs = torch.stack(
+        [
+            logits.float().log_softmax(dim=-1).gather(-1, tokens[:, None]).squeeze(-1)
+            for logits, tokens in zip(step_logits, generated.unbind(dim=1))
+        ],
+        dim=1,
+    )
+
+    scores = []
+    for tokens, logprobs in zip(generated.tolist(), token_logprobs.tolist()):
+        length = len(logprobs)
+        for i, token in enumerate(tokens[:length]):
+            if token in eos_ids:
+                length = i + 1
+                break
+        logprobs = [round(logprob, 4) for logprob in logprobs[:length]]
+        scores.append({"token_logprobs": logprobs, "logprob": round(sum(logprobs), 4)})
+    return scores
+
+
+def generate_predictions(
+    model, tokenizer, inputs, constrained=False, prefix_cache=None, return_scores=False
+):
+    """
+    Run model.generate on prepared inputs and decode only the generated tokens.
+
+    With return_scores=True the token log-probabilities are taken from the same
+    generate call, and a list of score dicts (see _sequence_scores) is returned
+    next to the list of predictions.
+    """
+    prompt_length = inputs["input_ids"].shape[1]
+    eos = eos_token_ids(model, tokenizer)
+    output_logits = {}
+    if return_scores:
+        output_logits = {"output_logits": True, "return_dict_in_generate": True}
+
+    if prefix_cache is not None:
+        logits_processor = LogitsProcessorList()
+        if constrained:
+            logits_processor.append(
+                CellGrammarLogitsProcessor(tokenizer, prompt_length, eos)
+            )
+        response = prefix_cache.generate(
+            inputs,
+            max_new_tokens=GRAMMAR_MAX_NEW_TOKENS if constrained else MAX_NEW_TOKENS,
+            logits_processor=logits_processor,
+            eos_token_ids=eos,
+            output_logits=return_scores,
+        )
+        if return_scores:
+            sequences, step_logits = response
+    elif constrained:
+        grammar = CellGrammarLogitsProcessor(tokenizer, prompt_length, eos)
+        response = model.generate(
+            **inputs,
+            max_new_tokens=GRAMMAR_MAX_NEW_TOKENS,
+            use_cache=True,
+            do_sample=False,
+            temperature=None,
+            min_p=None,
+            logits_processor=LogitsProcessorList([grammar]),
+            **output_logits,
+        )
+    else:
+        response = model.generate(
+            **inputs,
+            max_new_tokens=MAX_NEW_TOKENS,
+            use_cache=True,
+            temperature=TEMPERATURE,
+            min_p=MIN_P,
+            **output_logits,
+        )
+    if not return_scores:
+        sequences = response
+    elif prefix_cache is None:
+        sequences, step_logits = response.sequences, response.logits
+
+    generated = sequences[:, prompt_length:]
+    response_texts = tokenizer.batch_decode(generated, skip_special_tokens=True)
+    predictions = [_clean_response(text) for text in response_texts]
+    if return_scores:
+        return predictions, _sequence_scores(step_logits, generated, eos)
+    return predictions
+
+
+def _decoding_params(tokenizer, constrained, prefix_cache, return_scores=False):
+    # everything besides the image, model and prompt that changes the prediction
+    image_processor = getattr(tokenizer, "image_processor", None)
+    if constrained:
+        params = {"constrained": True, "max_new_tokens": GRAMMAR_MAX_NEW_TOKENS}
+    elif prefix_cache is not None:
+        params = {"greedy": True, "max_new_tokens": MAX_NEW_TOKENS}
+    else:
+        params = {
+            "temperature": TEMPERATURE,
+            "min_p": MIN_P,
+            "max_new_tokens": MAX_NEW_TOKENS,
+        }
+    if return_scores:
+        # the cached value then also holds the scores
+        params["scores"] = True
+    return {
+        **params,
+        "image_first": prefix_cache is None,
+        "min_pixels": getattr(image_processor, "min_pixels", None),
+        "max_pixels": getattr(image_processor, "max_pixels", None),
+    }
+
+
+def _cache_key(
+    cache,
+    model,
+    tokenizer,
+    image_bytes,
+    system_prompt,
+    constrained,
+    prefix_cache,
+    return_scores=False,
+):
+    return cache.make_key(
+        image_bytes,
+        model_identity(model),
+        system_prompt,
+        _decoding_params(tokenizer, constrained, prefix_cache, return_scores),
+    )
+
+
+def _to_cache(prediction, scores=None):
+    if scores is None:
+        return prediction
+    return json.dumps({"prediction": prediction, **scores})
+
+
+def _from_cache(value, return_scores):
+    if not return_scores:
+        return value
+    scores = json.loads(value)
+    return scores.pop("prediction"), scores
+
+
+def inference(
+    model,
+    tokenizer,
+    image_bytes,
+    system_prompt,
+    cache=None,
+    constrained=False,
+    prefix_cache=None,
+    return_scores=False,
+):
+    """
+    Read one cell image, cache is an optional prediction_cache.PredictionCache.
+
+    With constrained=True decoding is greedy and restricted to the cell grammar
+    in cell_grammar.py, so it stops as soon as a complete answer is generated.
+
+    prefix_cache is an optional prefix_cache.PrefixCache for the model. The
+    system prompt is then placed before the image (as in training), its KV cache
+    is computed once and reused, and decoding is greedy.
+
+    With return_scores=True a (prediction, scores) tuple is returned, scores
+    holds the log-probability of every generated token ("token_logprobs") and
+    of the whole answer ("logprob"), computed in the same generate pass.
+    """
+    if cache is not None:
+        key = _cache_key(
+            cache,
+            model,
+            tokenizer,
+            image_bytes,
+            system_prompt,
+            constrained,
+            prefix_cache,
+            return_scores,
+        )
+        cached = cache.get(key)
+        if cached is not None:
+            return _from_cache(cached, return_scores)
 
     image = prep_image(image_bytes)
-    messages = prepare_inference_sample(system_prompt)
+    messages = prepare_inference_sample(system_prompt, image_first=prefix_cache is None)
     input_text = tokenizer.apply_chat_template(messages, add_generation_prompt=True)
     inputs = tokenizer(
         image,
         input_text,
         add_special_tokens=False,
         return_tensors="pt",
-    ).to("cuda")
-
-    response = model.generate(
-        **inputs,
-        max_new_tokens=MAX_NEW_TOKENS,
-        use_cache=True,
-        temperature=TEMPERATURE,
-        min_p=MIN_P
-    )
+    ).to(model.device)
 
-    # Get only the generated tokens by finding where assistant response starts
-    response_text = tokenizer.decode(response[0], skip_special_tokens=True)
-    # Check for different possible formats of assistant marker
-    assistant_idx = -1
-    for marker in ["assistant\n", "assistant: ", "assistant : "]:
-        idx = response_text.find(marker)
-        if idx != -1:
-            assistant_idx = idx
-            assistant_marker = marker
-            break
-    if assistant_idx != -1:
-        response_text = response_text[assistant_idx + len(assistant_marker) :].strip()
+    result = generate_predictions(
+        model, tokenizer, inputs, constrained, prefix_cache, return_scores
+    )
+    if return_scores:
+        result = (result[0][0], result[1][0])
+        if cache is not None:
+            cache.put(key, _to_cache(*result))
+        return result
 
-    if response_text == "unknown":
-        response_text = ""
-    response_text = response_text.replace("\n", "")  # Remove newlines
+    response_text = result[0]
+    if cache is not None:
+        cache.put(key, response_text)
     return response_text
+
+
+def prompt_text(tokenizer, system_prompt, prefix_cache=None):
+    """Chat prompt for one cell, the image goes after the system prompt with a prefix cache"""
+    messages = prepare_inference_sample(system_prompt, image_first=prefix_cache is None)
+    return tokenizer.apply_chat_template(messages, add_generation_prompt=True)
+
+
+def batch_inputs(tokenizer, images, input_text):
+    """Tokenize a batch of PIL images with the same prompt, padding with the tokenizer's padding side"""
+    return tokenizer(
+        images,
+        [input_text] * len(images),
+        add_special_tokens=False,
+        padding=True,
+        return_tensors="pt",
+    )
+
+
+def inference_batch(
+    model,
+    tokenizer,
+    list_of_image_bytes,
+    system_prompt,
+    batch_size=BATCH_SIZE,
+    cache=None,
+    constrained=False,
+    prefix_cache=None,
+    return_scores=False,
+):
+    """
+    Run inference on many cell images, batch_size images per model.generate call.
+
+    Prompts are left padded so that generation starts at the same position for
+    every row in the batch. Returns the predictions in the same order as
+    list_of_image_bytes, post-processed exactly like inference(). With a cache,
+    only the images without a cached prediction are sent to the model.
+    constrained and prefix_cache work as in inference(). With
+    return_scores=True a (predictions, scores) tuple of lists is returned.
+    """
+    if cache is not None:
+        keys = [
+            _cache_key(
+                cache,
+                model,
+                tokenizer,
+                image_bytes,
+                system_prompt,
+                constrained,
+                prefix_cache,
+                return_scores,
+            )
+            for image_bytes in list_of_image_bytes
+        ]
+        cached = cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        new_results = inference_batch(
+            model,
+            tokenizer,
+            [list_of_image_bytes[i] for i in missing],
+            system_prompt,
+            batch_size,
+            constrained=constrained,
+            prefix_cache=prefix_cache,
+            return_scores=return_scores,
+        )
+        if return_scores:
+            new_values = [_to_cache(*result) for result in zip(*new_results)]
+        else:
+            new_values = new_results
+        cache.put_many((keys[i], value) for i, value in zip(missing, new_values))
+        cached.update((keys[i], value) for i, value in zip(missing, new_values))
+        results = [_from_cache(cached[key], return_scores) for key in keys]
+        if return_scores:
+            return [result[0] for result in results], [result[1] for result in results]
+        return results
+
+    input_text = prompt_text(tokenizer, system_prompt, prefix_cache)
+
+    # The processor wraps the text tokenizer, batched generation needs left padding
+    text_tokenizer = getattr(tokenizer, "tokenizer", tokenizer)
+    padding_side = text_tokenizer.padding_side
+    text_tokenizer.padding_side = "left"
+
+    predictions = []
+    scores = []
+    try:
+        for start in tqdm(
+            range(0, len(list_of_image_bytes), batch_size),
+            disable=len(list_of_image_bytes) <= batch_size,
+        ):
+            images = [
+                prep_image(image_bytes)
+                for image_bytes in list_of_image_bytes[start : start + batch_size]
+            ]
+            inputs = batch_inputs(tokenizer, images, input_text).to(model.device)
+
+            result = generate_predictions(
+                model, tokenizer, inputs, constrained, prefix_cache, return_scores
+            )
+            if return_scores:
+                predictions.extend(result[0])
+                scores.extend(result[1])
+            else:
+                predictions.extend(result)
+    finally:
+        text_tokenizer.padding_side = padding_side
+
+    if return_scores:
+        return predictions, scores
+    return predictions
@@ -0,0 +1,136 @@
+"""
+Append-only journal of an extraction run
+
+Every (column, row) prediction is appended to a JSON lines file as soon as it
+is done, so a run that crashes or gets pre-empted can be restarted and only
+does the remaining work. Label files are written from the journal once a
+column is complete.
+"""
+
+import json
+import os
+
+
+def write_lines_atomically(path, lines):
+    """Write lines to path through a temporary file, so readers never see a partial file"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        for line in lines:
+            f.write(line + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class RunJournal:
+    """Predictions of one run, keyed by (column, row) and persisted line by line"""
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            self._load()
+        self._file = open(path, "a")
+
+    def _load(self):
+        with open(self.path, "rb") as f:
+            content = f.read()
+
+        # the last line is cut off if the run was killed while writing it, drop it
+        # so that new records start on a fresh line
+        complete_size = content.rfind(b"\n") + 1
+        if complete_size < len(content):
+            with open(self.path, "r+b") as f:
+                f.truncate(complete_size)
+
+        for line in content[:complete_size].splitlines():
+            record = json.loads(line)
+            self.records[(record["column"], record["row"])] = record
+
+    def done_rows(self, column):
+        return {row for col, row in self.records if col == column}
+
+    def record_many(self, column, rows, predictions, **extra):
+        """
+        Append the predictions for the given rows and flush them to disk.
+
+        extra holds optional per-row lists of additional values (e.g. scores)
+        that are stored next to each prediction.
+        """
+        for i, (row, prediction) in enumerate(zip(rows, predictions)):
+            record = {"column": column, "row": int(row), "prediction": prediction}
+            for name, values in extra.items():
+                record[name] = values[i]
+            self._file.write(json.dumps(record) + "\n")
+            self.records[(column, int(row))] = record
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def record(self, column, row, prediction, **extra):
+        self.record_many(
+            column,
+            [row],
+            [prediction],
+            **{name: [value] for name, value in extra.items()},
+        )
+
+    def values(self, column, rows, field="prediction"):
+        """
+        Values for the given rows of a column, or None if some rows are not done yet.
+
+        Rows recorded without the field (blank filtered rows have no logprob)
+        give None.
+        """
+        keys = [(column, int(row)) for row in rows]
+        if any(key not in self.records for key in keys):
+            return None
+        return [self.records[key].get(field) for key in keys]
+
+    def column_values(self, column, num_rows, field="prediction"):
+        """Values of a column in row order, or None if some rows are not done yet"""
+        return self.values(column, range(num_rows), field)
+
+    def least_confident_rows(self, column, max_logprob=None, count=None):
+        """
+        Rows of a column ordered from the lowest sequence logprob up.
+
+        Only rows recorded with a "logprob" are considered (blank filtered rows
+        have none). Keeps rows with logprob <= max_logprob and at most count
+        rows, so review and re-inference can start with the uncertain tail.
+        """
+        scored = [
+            (record["logprob"], row)
+            for (col, row), record in self.records.items()
+            if col == column and record.get("logprob") is not None
+        ]
+        scored.sort()
+        if max_logprob is not None:
+            scored = [
+                (logprob, row) for logprob, row in scored if logprob <= max_logprob
+            ]
+        return [row for _, row in scored[:count]]
+
+    def materialize(
+        self, column, num_rows, labels_path, overwrite=False, field="prediction"
+    ):
+        """
+        Write a finished column to a label file, one value per line.
+
+        Existing label files may contain manual corrections, so they are only
+        replaced with overwrite=True. Returns True if the file was written.
+        field selects what is written, missing values are written as empty lines.
+        """
+        values = self.column_values(column, num_rows, field)
+        if values is None:
+            raise ValueError(f"Column {column} is not finished in {self.path}")
+        if os.path.exists(labels_path) and not overwrite:
+            return False
+        write_lines_atomically(
+            labels_path, ["" if value is None else str(value) for value in values]
+        )
+        return True
+
+    def close(self):
+        self._file.close()
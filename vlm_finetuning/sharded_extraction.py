@@ -0,0 +1,409 @@
+"""
+Run the extraction of all fields over several model-holding worker processes
+
+The (column, row) grid is split into shards, each covering SHARD_ROWS rows of
+one column. Workers claim shards by atomically creating a claim file in the run
+directory, so any number of workers on one or several hosts sharing the
+filesystem can work through the same run. A worker touches its claim file while
+it processes the shard, and claims without a heartbeat are handed out again by
+creating the next generation of the claim file, which only one worker can do.
+Each shard has its own run journal, so a killed worker only loses its current
+batch, and a restarted worker with the same name resumes its own shards. Once all shards are done,
+the predictions are merged from the journals into the label store.
+
+    # four workers on this machine
+    python sharded_extraction.py --run-dir runs/full --model ./finetuned_qwen_models/lora_model_20250414_134955 --workers 4
+
+    # start the same command on other hosts to add more workers, then merge
+    python sharded_extraction.py --run-dir runs/full --merge
+"""
+
+import argparse
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+import torch
+
+from constants import (
+    SYSTEM_PROMPT,
+    BATCH_SIZE,
+    METADATA_FIELDS,
+    SHARD_ROWS,
+    CLAIM_HEARTBEAT_SECONDS,
+    STALE_CLAIM_SECONDS,
+    PHENOLOGY_DATASET_PATH,
+    LABEL_STORE_PATH,
+)
+from blank_filter import find_blank_cells
+from run_journal import RunJournal, write_lines_atomically
+from label_store import LabelStore
+from columnar_store import load_columns
+
+
+def extraction_columns(df):
+    """All fields with cell images, except the metadata fields"""
+    return [
+        col[: -len("_image")]
+        for col in df.columns
+        if col.endswith("_image") and col[: -len("_image")] not in METADATA_FIELDS
+    ]
+
+
+def make_shards(columns, num_rows, shard_rows=SHARD_ROWS):
+    """Deterministic list of shards, each a dict with id, column and a row range"""
+    shards = []
+    for col in columns:
+        for row_start in range(0, num_rows, shard_rows):
+            shards.append(
+                {
+                    "id": len(shards),
+                    "column": col,
+                    "row_start": row_start,
+                    "row_end": min(row_start + shard_rows, num_rows),
+                }
+            )
+    return shards
+
+
+def _create_exclusive(path, content):
+    """Create path with content, returns False if it already exists"""
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        f.write(content)
+    return True
+
+
+class ShardedRun:
+    """Shard bookkeeping of one extraction run in a directory on a shared filesystem"""
+
+    def __init__(self, run_dir, shards=None, worker_name=None):
+        self.run_dir = run_dir
+        self.worker_name = worker_name or _worker_name()
+        os.makedirs(os.path.join(run_dir, "claims"), exist_ok=True)
+        os.makedirs(os.path.join(run_dir, "journals"), exist_ok=True)
+
+        # the first process defines the shards, everybody else reads them
+        shards_path = os.path.join(run_dir, "shards.json")
+        if shards is not None and not os.path.exists(shards_path):
+            tmp_path = f"{shards_path}.{socket.gethostname()}.{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump(shards, f)
+            try:
+                # link fails if another process got there first, so the file is always complete
+                os.link(tmp_path, shards_path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp_path)
+        with open(shards_path, "r") as f:
+            self.shards = json.load(f)
+        if shards is not None and shards != self.shards:
+            raise ValueError(f"{run_dir} was started with different shards")
+
+    def _path(self, kind, shard):
+        extension = {"journals": "jsonl", "done": "done"}[kind]
+        return os.path.join(
+            self.run_dir, "journals", f"shard_{shard['id']:05d}.{extension}"
+        )
+
+    def _claim_path(self, shard, generation):
+        return os.path.join(
+            self.run_dir, "claims", f"shard_{shard['id']:05d}.claim.{generation}"
+        )
+
+    def _claim_generation(self, shard):
+        """Generation of the current claim of shard, -1 if it was never claimed"""
+        # generation g + 1 is only ever created next to g, so they have no gaps
+        generation = -1
+        while os.path.exists(self._claim_path(shard, generation + 1)):
+            generation += 1
+        return generation
+
+    def _filesystem_time(self):
+        """
+        Current time of the shared filesystem, the mtime of a file written now.
+        Heartbeats are file mtimes too, so clock skew between hosts cancels out.
+        """
+        clock_path = os.path.join(self.run_dir, "claims", f".clock_{_worker_name()}")
+        with open(clock_path, "w") as f:
+            f.write(self.worker_name)
+        return os.path.getmtime(clock_path)
+
+    def journal_path(self, shard):
+        return self._path("journals", shard)
+
+    def is_done(self, shard):
+        return os.path.exists(self._path("done", shard))
+
+    def mark_done(self, shard):
+        write_lines_atomically(self._path("done", shard), [self.worker_name])
+
+    def owns(self, shard):
+        """Whether the current claim of shard is held by this worker"""
+        generation = self._claim_generation(shard)
+        if generation < 0:
+            return False
+        with open(self._claim_path(shard, generation), "r") as f:
+            return f.read() == self.worker_name
+
+    def claim(self, shard, stale_after=STALE_CLAIM_SECONDS):
+        """
+        Try to claim a shard for this worker, returns True on success.
+
+        A claim whose heartbeat is older than stale_after is taken over. A
+        claim held under this worker's name is left by a previous process of
+        this worker (e.g. restarted after pre-emption), it is taken over as
+        soon as that process has missed two heartbeats.
+
+        Claiming creates the next generation of the claim file exclusively, so
+        when several workers see the same stale claim only one of them takes
+        it over.
+        """
+        if self.is_done(shard):
+            return False
+        generation = self._claim_generation(shard)
+        if generation >= 0:
+            claim_path = self._claim_path(shard, generation)
+            with open(claim_path, "r") as f:
+                owner = f.read()
+            last_heartbeat = os.path.getmtime(claim_path)
+            if owner == self.worker_name:
+                stale_after = min(stale_after, 2 * CLAIM_HEARTBEAT_SECONDS)
+            if self._filesystem_time() - last_heartbeat <= stale_after:
+                return False
+            # the worker holding the claim is presumably gone, its journal lets us resume
+        if not _create_exclusive(
+            self._claim_path(shard, generation + 1), self.worker_name
+        ):
+            return False
+        return self.owns(shard)
+
+    @contextlib.contextmanager
+    def heartbeat(self, shard, interval=CLAIM_HEARTBEAT_SECONDS):
+        """Touch the claim file of shard every interval seconds inside the block"""
+        claim_path = self._claim_path(shard, self._claim_generation(shard))
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(interval):
+                try:
+                    os.utime(claim_path)
+                except FileNotFoundError:
+                    return
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def remaining(self):
+        return [shard for shard in self.shards if not self.is_done(shard)]
+
+
+def _worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _process_shard(run, shard, images, model, tokenizer, use_blank_filter, **kwargs):
+    from qwen_helper_funcs import inference_batch
+
+    column = shard["column"]
+    journal = RunJournal(run.journal_path(shard))
+    done_rows = journal.done_rows(column)
+    rows = np.arange(shard["row_start"], shard["row_end"])
+    rows = rows[[row not in done_rows for row in rows]]
+
+    if len(rows) > 0 and use_blank_filter:
+        is_blank = find_blank_cells(images[rows])
+        journal.record_many(column, rows[is_blank], [""] * int(is_blank.sum()))
+        rows = rows[~is_blank]
+
+    for start in range(0, len(rows), BATCH_SIZE):
+        batch_rows = rows[start : start + BATCH_SIZE]
+        predictions, scores = inference_batch(
+            model,
+            tokenizer,
+            images[batch_rows],
+            SYSTEM_PROMPT,
+            return_scores=True,
+            **kwargs,
+        )
+        journal.record_many(
+            column,
+            batch_rows,
+            predictions,
+            logprob=[score["logprob"] for score in scores],
+            token_logprobs=[score["token_logprobs"] for score in scores],
+        )
+
+    journal.close()
+    run.mark_done(shard)
+
+
+def run_worker(
+    run_dir,
+    dataset_path,
+    model_path=None,
+    device=None,
+    num_workers=1,
+    use_blank_filter=True,
+    constrained=True,
+    worker_name=None,
+):
+    """
+    Load the model once, then process shards until all of them are done.
+
+    worker_name (default: host:pid) names the claims of this worker. A stable
+    name such as host:worker_index lets a restarted worker take its own
+    unfinished shards back right away. Once nothing is left to claim, the
+    worker waits for shards of other workers that are done or go stale.
+    """
+    from qwen_helper_funcs import load_model
+
+    run = ShardedRun(run_dir, worker_name=worker_name)
+    model, tokenizer = load_model(model_path, device, num_workers=num_workers)
+    # image columns are read lazily, only the claimed shards' cells are loaded
+    df = load_columns(dataset_path)
+
+    while True:
+        remaining = run.remaining()
+        if not remaining:
+            break
+        claimed_any = False
+        for shard in remaining:
+            if not run.claim(shard):
+                continue
+            claimed_any = True
+            print(f"{run.worker_name}: shard {shard['id']} ({shard['column']})")
+            images = df[shard["column"] + "_image"].values
+            with run.heartbeat(shard):
+                _process_shard(
+                    run,
+                    shard,
+                    images,
+                    model,
+                    tokenizer,
+                    use_blank_filter,
+                    constrained=constrained,
+                )
+        if not claimed_any:
+            time.sleep(CLAIM_HEARTBEAT_SECONDS)
+
+
+def merge_run(run_dir, label_store_path=LABEL_STORE_PATH, source=None, overwrite=False):
+    """
+    Write the predictions of every column from the shard journals to the label
+    store, with confidence exp(logprob) and source (default: the run directory
+    name).
+
+    Human labels are only replaced with overwrite=True, since they are manual
+    corrections.
+    """
+    run = ShardedRun(run_dir)
+    remaining = run.remaining()
+    if remaining:
+        raise RuntimeError(f"{len(remaining)} shards of {run_dir} are not done yet")
+    source = source or os.path.basename(os.path.normpath(run_dir))
+
+    shards_by_column = {}
+    for shard in run.shards:
+        shards_by_column.setdefault(shard["column"], []).append(shard)
+
+    labels = LabelStore(label_store_path)
+    for column, shards in shards_by_column.items():
+        rows = []
+        predictions = []
+        logprobs = []
+        for shard in sorted(shards, key=lambda shard: shard["row_start"]):
+            journal = RunJournal(run.journal_path(shard))
+            shard_rows = range(shard["row_start"], shard["row_end"])
+            rows.extend(shard_rows)
+            predictions.extend(journal.values(column, shard_rows))
+            logprobs.extend(journal.values(column, shard_rows, "logprob"))
+            journal.close()
+
+        changed = labels.put_many(
+            column,
+            rows,
+            predictions,
+            source,
+            [None if logprob is None else math.exp(logprob) for logprob in logprobs],
+            overwrite=overwrite,
+        )
+        print(f"{column}: {changed} labels written to {label_store_path}")
+    labels.close()
+
+
+def _device_for_worker(worker_index):
+    if torch.cuda.is_available():
+        return f"cuda:{worker_index % torch.cuda.device_count()}"
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--run-dir", required=True)
+    parser.add_argument("--data", default=PHENOLOGY_DATASET_PATH)
+    parser.add_argument("--model", default=None, help="path to a LoRA model")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="worker processes on this host"
+    )
+    parser.add_argument(
+        "--columns", nargs="*", default=None, help="default: all fields"
+    )
+    parser.add_argument("--no-blank-filter", action="store_true")
+    parser.add_argument(
+        "--merge", action="store_true", help="only merge finished shards"
+    )
+    parser.add_argument("--label-store", default=LABEL_STORE_PATH)
+    args = parser.parse_args()
+
+    if not args.merge:
+        df = load_columns(args.data)
+        columns = args.columns or extraction_columns(df)
+        ShardedRun(args.run_dir, make_shards(columns, len(df)))
+        del df
+
+        context = multiprocessing.get_context("spawn")
+        workers = [
+            context.Process(
+                target=run_worker,
+                args=(
+                    args.run_dir,
+                    args.data,
+                    args.model,
+                    _device_for_worker(i),
+                    args.workers,
+                    not args.no_blank_filter,
+                ),
+                # stable names, so a restarted worker resumes its own shards
+                kwargs={"worker_name": f"{socket.gethostname()}:worker{i}"},
+            )
+            for i in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    if not ShardedRun(args.run_dir).remaining():
+        merge_run(args.run_dir, args.label_store)
+    else:
+        print(
+            "Shards are still being processed by other workers, run with --merge later"
+        )
@@ -0,0 +1,195 @@
+"""
+Spend the vision tokens of a cell on its ink
+
+Prefill cost grows with the number of vision tokens, and the processor gives
+every cell the same pixel budget however little it contains. Most cells hold
+1-3 glyphs surrounded by paper and grid lines. crop_cells cuts every cell down
+to the bounding box of its ink, so a much smaller pixel budget still resolves
+the glyphs, and calibrate_pixel_budget picks the smallest budget that keeps the
+accuracy on labelled cells.
+
+Run this file to calibrate the budget for a model on the labelled dataset.
+"""
+
+import io
+
+import numpy as np
+import pandas as pd
+from PIL import Image as PILImage
+
+from blank_filter import cells_to_stack, label_ink
+from constants import (
+    INK_THRESHOLD,
+    MIN_COMPONENT_SIZE,
+    CROP_PADDING,
+    MIN_CROP_SIZE,
+    PIXEL_BUDGETS,
+    SYSTEM_PROMPT,
+)
+
+
+def ink_bounding_boxes(
+    stack,
+    ink_threshold=INK_THRESHOLD,
+    min_component_size=MIN_COMPONENT_SIZE,
+    padding=CROP_PADDING,
+    min_size=MIN_CROP_SIZE,
+    **border_kwargs,
+):
+    """
+    Bounding box of the ink in every cell of a stack, as (top, bottom, left, right).
+
+    The ruling lines at the cell edges are stripped first (see
+    blank_filter.strip_borders, border_kwargs are passed on), and connected
+    components smaller than min_component_size (specks) are ignored. Boxes are
+    grown by padding pixels, and to at least min_size pixels per side where
+    the cell is large enough. Cells without ink get the box inside their
+    ruling lines.
+    """
+    num_cells, height, width = stack.shape
+    _, labels, _, content_boxes = label_ink(stack, ink_threshold, **border_kwargs)
+    is_large = np.bincount(labels.ravel()) >= min_component_size
+    is_large[0] = False  # background
+    ink = is_large[labels]
+
+    rows = ink.any(axis=2)
+    cols = ink.any(axis=1)
+    has_ink = rows.any(axis=1)
+    top = rows.argmax(axis=1)
+    bottom = rows.shape[1] - rows[:, ::-1].argmax(axis=1)
+    left = cols.argmax(axis=1)
+    right = cols.shape[1] - cols[:, ::-1].argmax(axis=1)
+
+    boxes = np.stack([top, bottom, left, right], axis=1)
+    boxes[~has_ink] = content_boxes[~has_ink]
+    for start, end, size in [(0, 1, height), (2, 3, width)]:
+        # grow around the center, then shift boxes that stick out back into the cell
+        grow = np.maximum(min_size - (boxes[:, end] - boxes[:, start]), 2 * padding)
+        boxes[:, start] -= grow // 2
+        boxes[:, end] += grow - grow // 2
+        boxes[:, end] -= np.minimum(boxes[:, start], 0)
+        boxes[:, start] -= np.maximum(boxes[:, end] - size, 0)
+        boxes[:, start] = np.maximum(boxes[:, start], 0)
+        boxes[:, end] = np.minimum(boxes[:, end], size)
+    return boxes
+
+
+def crop_cells(list_of_image_bytes, **kwargs):
+    """
+    Crop cell images to the bounding box of their ink.
+
+    Returns PNG encoded grayscale cells that can be passed to inference and
+    inference_batch like the originals. kwargs go to ink_bounding_boxes.
+    """
+    stack = cells_to_stack(list_of_image_bytes)
+    cropped = []
+    for cell, (top, bottom, left, right) in zip(
+        stack, ink_bounding_boxes(stack, **kwargs)
+    ):
+        image_bytes = io.BytesIO()
+        PILImage.fromarray(cell[top:bottom, left:right]).save(image_bytes, format="PNG")
+        cropped.append(image_bytes.getvalue())
+    return cropped
+
+
+def set_pixel_budget(tokenizer, max_pixels, min_pixels=None):
+    """
+    Resize every image to about max_pixels pixels before it is split into patches.
+
+    min_pixels defaults to max_pixels, so small crops are scaled up to the
+    budget as in get_model_and_processor. The budget is part of the prediction
+    cache key.
+    """
+    min_pixels = max_pixels if min_pixels is None else min_pixels
+    image_processor = getattr(tokenizer, "image_processor", tokenizer)
+    image_processor.min_pixels = min_pixels
+    image_processor.max_pixels = max_pixels
+    image_processor.size = {"shortest_edge": min_pixels, "longest_edge": max_pixels}
+
+
+def vision_tokens_per_cell(tokenizer, list_of_image_bytes):
+    """Mean number of vision tokens the language model sees per cell"""
+    from prepare_data_qwen import prep_image
+
+    image_processor = tokenizer.image_processor
+    grid_thw = image_processor(
+        [prep_image(image_bytes) for image_bytes in list_of_image_bytes],
+        return_tensors="pt",
+    )["image_grid_thw"]
+    # patches are merged merge_size x merge_size into one token
+    tokens = grid_thw.prod(dim=1) // image_processor.merge_size**2
+    return float(tokens.float().mean())
+
+
+def calibrate_pixel_budget(
+    model,
+    tokenizer,
+    list_of_image_bytes,
+    ground_truth,
+    budgets=PIXEL_BUDGETS,
+    max_accuracy_drop=0.0,
+    **kwargs,
+):
+    """
+    Smallest pixel budget for cropped cells that keeps the accuracy.
+
+    The reference is the accuracy of the uncropped cells with the processor's
+    current settings. Every budget in budgets is tried on the cropped cells,
+    and the smallest one within max_accuracy_drop of the reference is
+    returned (None if no budget is good enough), together with a DataFrame of
+    accuracy and vision tokens per setting. kwargs go to inference_batch.
+    The processor settings are restored afterwards.
+    """
+    from qwen_helper_funcs import inference_batch
+
+    ground_truth = np.asarray(ground_truth)
+    image_processor = tokenizer.image_processor
+    original = (image_processor.min_pixels, image_processor.max_pixels)
+
+    def evaluate(cells, budget, cropped):
+        predictions = inference_batch(model, tokenizer, cells, SYSTEM_PROMPT, **kwargs)
+        return {
+            "budget": budget,
+            "cropped": cropped,
+            "vision_tokens": vision_tokens_per_cell(tokenizer, cells),
+            "accuracy": float(np.mean(np.array(predictions) == ground_truth)),
+        }
+
+    rows = [evaluate(list_of_image_bytes, original[1], cropped=False)]
+    cropped_cells = crop_cells(list_of_image_bytes)
+    try:
+        for budget in sorted(budgets):
+            set_pixel_budget(tokenizer, budget)
+            rows.append(evaluate(cropped_cells, budget, cropped=True))
+    finally:
+        set_pixel_budget(tokenizer, original[1], original[0])
+
+    report = pd.DataFrame(rows)
+    reference = report["accuracy"].iloc[0]
+    good = report[
+        report["cropped"] & (report["accuracy"] >= reference - max_accuracy_drop)
+    ]
+    best_budget = None if good.empty else int(good["budget"].min())
+    return best_budget, report
+
+
+if __name__ == "__main__":
+    from columnar_store import load_columns
+    from qwen_helper_funcs import load_model
+
+    LORA_MODEL_PATH = "./finetuned_qwen_models/lora_model_20250414_134955"
+    columns = ["coltsfoot_flowering", "hazel_flowering"]
+    df = load_columns(
+        "data/df_labelled_all.pkl",
+        [col + suffix for col in columns for suffix in ("_image", "_labels")],
+    )
+
+    model, tokenizer = load_model(LORA_MODEL_PATH)
+    images = np.concatenate([df[col + "_image"].values for col in columns])
+    ground_truth = np.concatenate([df[col + "_labels"].values for col in columns])
+
+    best_budget, report = calibrate_pixel_budget(
+        model, tokenizer, images, ground_truth, constrained=True
+    )
+    print(report.to_string(index=False))
+    print(f"Smallest pixel budget that keeps the accuracy: {best_budget}")
@@ -0,0 +1,266 @@
+"""
+Preprocess the fine-tuning samples once instead of every epoch
+
+UnslothVisionDataCollator runs the processor (chat template, tokenization,
+resize, patchify and normalize) on every batch, so every epoch preprocesses
+the same cells again and CPU-limited hosts wait on it. build_vision_cache runs
+the processor once per sample and writes its outputs to a directory with
+
+- input_ids.bin: the token ids of every sample, one after the other (int32)
+- pixel_values.bin: the image patches of every sample, (num_patches, patch_dim)
+- image_grid_thw.npy: the (t, h, w) patch grid of every sample
+- offsets.npy: (num_samples + 1, 2) offsets of every sample in the token and
+  patch files
+- meta.json: sizes, dtype and the key of the dataset, cell images and processor
+  settings
+
+VisionCache reads a sample from the memory-mapped files on access, and
+CachedVisionCollator pads them into a batch with the same keys and labels as
+UnslothVisionDataCollator (padding and vision tokens are not trained on).
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+import columnar_store
+
+INPUT_IDS_FILE = "input_ids.bin"
+PIXEL_VALUES_FILE = "pixel_values.bin"
+GRID_FILE = "image_grid_thw.npy"
+OFFSETS_FILE = "offsets.npy"
+META_FILE = "meta.json"
+VISION_TOKENS = ["<|vision_start|>", "<|vision_end|>", "<|image_pad|>"]
+IGNORE_INDEX = -100
+
+
+def _text_tokenizer(tokenizer):
+    # the processor wraps the text tokenizer
+    return getattr(tokenizer, "tokenizer", tokenizer)
+
+
+def _image_fingerprint(images):
+    """Changes whenever a cell image of the column changes"""
+    if isinstance(images, columnar_store.ImageColumn):
+        # write_columnar rewrites the store files, their size and mtime are enough
+        stats = [
+            os.stat(os.path.join(images.path, name))
+            for name in (columnar_store.IMAGES_FILE, columnar_store.OFFSETS_FILE)
+        ]
+        return [
+            os.path.abspath(images.path),
+            images.column_index,
+            [[stat.st_size, stat.st_mtime_ns] for stat in stats],
+        ]
+    # images held in memory, e.g. from a pickled DataFrame
+    digest = hashlib.sha1()
+    for image_bytes in images:
+        digest.update(len(image_bytes).to_bytes(8, "little"))
+        digest.update(image_bytes)
+    return digest.hexdigest()
+
+
+def _cache_key(dataset, tokenizer):
+    """Dataset samples, cell images and processor settings the cache was built from"""
+    image_processor = getattr(tokenizer, "image_processor", None)
+    key = hashlib.sha1()
+    key.update(
+        json.dumps(
+            [
+                _text_tokenizer(tokenizer).name_or_path,
+                getattr(image_processor, "min_pixels", None),
+                getattr(image_processor, "max_pixels", None),
+                dataset.system_prompt,
+                dataset.image_columns,
+                [
+                    _image_fingerprint(dataset.images[col])
+                    for col in dataset.image_columns
+                ],
+            ]
+        ).encode()
+    )
+    for array in (dataset.columns, dataset.rows):
+        key.update(np.ascontiguousarray(array, dtype=np.int64).tobytes())
+    key.update("\n".join(dataset.labels).encode())
+    return key.hexdigest()
+
+
+def _sample_images(messages):
+    return [
+        item["image"]
+        for message in messages
+        for item in message["content"]
+        if item["type"] == "image"
+    ]
+
+
+def build_vision_cache(
+    dataset, tokenizer, path, batch_size=64, dtype=np.float32, overwrite=False
+):
+    """
+    Run the processor on every sample of a CellConversations dataset and store
+    the outputs at path. Returns the VisionCache.
+
+    A cache built from the same samples, cell images and processor settings
+    is reused. The images are fingerprinted by the size and modification time
+    of the columnar store files (or their bytes when held in memory), so
+    re-extracted or migrated cells rebuild the cache. dtype=np.float16 halves
+    the size of the pixel values.
+    """
+    key = _cache_key(dataset, tokenizer)
+    meta_path = os.path.join(path, META_FILE)
+    if not overwrite and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f)["key"] == key:
+                return VisionCache(path)
+    os.makedirs(path, exist_ok=True)
+
+    offsets = np.zeros((len(dataset) + 1, 2), dtype=np.int64)
+    grids = []
+    patch_dim = 0
+    with open(os.path.join(path, INPUT_IDS_FILE), "wb") as ids_file, open(
+        os.path.join(path, PIXEL_VALUES_FILE), "wb"
+    ) as pixels_file:
+        for start in tqdm(range(0, len(dataset), batch_size)):
+            samples = [
+                dataset[i]["messages"]
+                for i in range(start, min(start + batch_size, len(dataset)))
+            ]
+            # the same inputs UnslothVisionDataCollator builds, without padding
+            batch = tokenizer(
+                text=[
+                    tokenizer.apply_chat_template(messages, tokenize=False)
+                    for messages in samples
+                ],
+                images=[
+                    image for messages in samples for image in _sample_images(messages)
+                ],
+            )
+            grid = np.asarray(batch["image_grid_thw"], dtype=np.int64)
+            pixel_values = np.asarray(batch["pixel_values"], dtype=dtype)
+            patch_dim = pixel_values.shape[1]
+            pixels_file.write(pixel_values.tobytes())
+            grids.append(grid)
+
+            # one image per sample, so sample i has the patches of image i
+            num_patches = grid.prod(axis=1)
+            for i, input_ids in enumerate(batch["input_ids"]):
+                ids_file.write(np.asarray(input_ids, dtype=np.int32).tobytes())
+                offsets[start + i + 1] = offsets[start + i] + [
+                    len(input_ids),
+                    num_patches[i],
+                ]
+
+    np.save(os.path.join(path, GRID_FILE), np.concatenate(grids))
+    np.save(os.path.join(path, OFFSETS_FILE), offsets)
+    with open(meta_path, "w") as f:
+        json.dump(
+            {
+                "num_samples": len(dataset),
+                "patch_dim": patch_dim,
+                "pixel_dtype": np.dtype(dtype).name,
+                "key": key,
+            },
+            f,
+        )
+    return VisionCache(path)
+
+
+class VisionCache:
+    """Preprocessed samples read from the memory-mapped cache files on access"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self._input_ids = None
+        self._pixel_values = None
+
+    def _open(self):
+        if self._input_ids is None:
+            self._input_ids = np.memmap(
+                os.path.join(self.path, INPUT_IDS_FILE), dtype=np.int32, mode="r"
+            )
+            self._pixel_values = np.memmap(
+                os.path.join(self.path, PIXEL_VALUES_FILE),
+                dtype=self.meta["pixel_dtype"],
+                mode="r",
+            ).reshape(-1, self.meta["patch_dim"])
+            self._grids = np.load(os.path.join(self.path, GRID_FILE))
+            self._offsets = np.load(os.path.join(self.path, OFFSETS_FILE))
+
+    def __getstate__(self):
+        # data loader workers map the files themselves
+        state = self.__dict__.copy()
+        state["_input_ids"] = state["_pixel_values"] = None
+        return state
+
+    def __len__(self):
+        return self.meta["num_samples"]
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(f"sample {i} out of range for {len(self)} samples")
+        self._open()
+        (token_start, patch_start), (token_end, patch_end) = self._offsets[i : i + 2]
+        return {
+            "input_ids": self._input_ids[token_start:token_end],
+            "pixel_values": self._pixel_values[patch_start:patch_end],
+            "image_grid_thw": self._grids[i],
+        }
+
+
+class CachedVisionCollator:
+    """
+    Batches VisionCache samples for the trainer, in place of
+    UnslothVisionDataCollator. Padding, attention mask and labels follow the
+    text tokenizer's padding side and pad token, and the pixel values are cast
+    to dtype (default: as stored).
+    """
+
+    def __init__(self, tokenizer, dtype=None):
+        text_tokenizer = _text_tokenizer(tokenizer)
+        self.pad_token_id = text_tokenizer.pad_token_id
+        self.padding_side = text_tokenizer.padding_side
+        self.vision_token_ids = torch.tensor(
+            text_tokenizer.convert_tokens_to_ids(VISION_TOKENS)
+        )
+        self.dtype = dtype
+
+    def __call__(self, samples):
+        max_length = max(len(sample["input_ids"]) for sample in samples)
+        input_ids = torch.full((len(samples), max_length), self.pad_token_id)
+        attention_mask = torch.zeros((len(samples), max_length), dtype=torch.long)
+        for i, sample in enumerate(samples):
+            length = len(sample["input_ids"])
+            columns = (
+                slice(max_length - length, None)
+                if self.padding_side == "left"
+                else slice(0, length)
+            )
+            input_ids[i, columns] = torch.from_numpy(
+                sample["input_ids"].astype(np.int64)
+            )
+            attention_mask[i, columns] = 1
+
+        labels = input_ids.masked_fill(attention_mask == 0, IGNORE_INDEX)
+        labels[torch.isin(labels, self.vision_token_ids)] = IGNORE_INDEX
+
+        pixel_values = torch.from_numpy(
+            np.concatenate([sample["pixel_values"] for sample in samples])
+        )
+        if self.dtype is not None:
+            pixel_values = pixel_values.to(self.dtype)
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "pixel_values": pixel_values,
+            "image_grid_thw": torch.from_numpy(
+                np.stack([sample["image_grid_thw"] for sample in samples])
+            ),
+            "labels": labels,
+        }